@@ -11,14 +11,64 @@ import arcpy
 
 arcpy.CheckOutExtension('Spatial')
 from arcpy.sa import *
-from collections import defaultdict
-import json
 from math import *
+import numpy as np
 import os
 import sys
+import time
 
 sys.dont_write_bytecode = True
 
+from scripts.utils.amror_core import CLASS_NODATA, degrees_to_mils, fan_extent, sweep_inclination, threshold_classes
+from scripts.utils import amror_core
+from scripts.utils.align import read_aligned
+from scripts.utils.arcarray import TileWriter, feature_polygons, read_window
+from scripts.utils.grid import Grid
+from scripts.utils.parallel import ordered_map, timing_summary
+from scripts.utils.rasterize import burn_polygons
+from scripts.utils.tilecache import TileCache, dataset_stamp
+
+
+def inclination_tile(tile, mask, dsm, dtm, bearings, distances, vert_offsets, interval, thresholds=None,
+                     method='nearest'):
+    """
+    Maximum inclination in mils for one tile of the AO grid, reading only the
+    DTM under the tile (resampled onto the tile's cells by scripts.utils.align)
+    and the DSM the tile's rays can reach.  Only cells in the
+    mask (None for all) are evaluated and both rasters are read with the
+    scripts.utils.sampler method given.  Returns a float32 array (band-first when
+    there is more than one combination) and the combos.
+
+    With mil thresholds the result is instead the uint8 count of thresholds at
+    or below each cell's inclination, from threshold_classes().
+    """
+    # One cell of padding keeps bilinear samples at the window edges whole
+    dsm_win = read_window(dsm, *fan_extent(*tile.extent, bearings, max(distances)), pad=1)
+    if thresholds:
+        # A little DTM past the tile edge keeps the edge blocks' bounds tight
+        dtm_win = read_aligned(dtm, tile.subgrid(-4, -4, tile.nrows + 8, tile.ncols + 8), method)
+        incl_mils, combos, _ = threshold_classes(
+            tile, dtm_win, dsm_win, bearings, distances, vert_offsets, interval, thresholds, mask=mask, method=method)
+    else:
+        dtm_win = read_aligned(dtm, tile, method)
+        max_degs, combos = sweep_inclination(
+            tile, dtm_win, dsm_win, bearings, distances, vert_offsets, interval, mask, method)
+        incl_mils = degrees_to_mils(max_degs).astype(np.float32)
+    if len(combos) == 1:
+        incl_mils = incl_mils[0]
+    return incl_mils, combos
+
+
+def inclination_job(job):
+    """
+    Process pool entry point: run inclination_tile() for (tile number, tile, mask, args)
+    and hand back the tile number and run time with the result.
+    """
+    start = time.perf_counter()
+    number, tile, mask, args = job
+    incl_mils, combos = inclination_tile(tile, mask, *args)
+    return number, incl_mils, combos, time.perf_counter() - start
+
 
 class AreaMaxRiseOverRun(object):
 
@@ -33,16 +83,21 @@ class AreaMaxRiseOverRun(object):
     def getParameterInfo(self):
         
         pdata = [
-            ['Area of Operations', 'area_of_operations', 'GPString', 'Required', 'Input'],
-            ['AO Layer', 'ao_layer', 'GPFeatureLayer', 'Optional', 'Input'],
-            ['Surface Raster (DSM)', 'surface_raster', ['GPRasterLayer', 'GPRasterDataLayer', 'GPMapServerLayer', 'DEImageServer', 'GPMosaicLayer'], 'Required', 'Input'],
-            ['Bare Earth Raster (DTM)', 'terrain_raster', ['GPRasterLayer', 'GPRasterDataLayer', 'GPMapServerLayer', 'DEImageServer', 'GPMosaicLayer'], 'Required', 'Input'],
-            ['Cell Size (meters)', 'cell_size', 'GPLong', 'Required', 'Input'],
-            ['Distance (meters)', 'distance', 'GPLong', 'Required', 'Input'],
-            ['Bearing (degrees)', 'bearing', 'GPLong', 'Required', 'Input'],
-            ['Interval (meters)', 'interval', 'GPLong', 'Required', 'Input'],
-            ['Vertical Offset (meters)', 'vertical_offset', 'GPLong', 'Required', 'Input'],
-            ['Raster Output', 'raster_output', 'DERasterDataset', 'Optional', 'Output']
+            ['Area of Operations', 'area_of_operations', 'GPString', 'Required', 'Input', False],
+            ['AO Layer', 'ao_layer', 'GPFeatureLayer', 'Optional', 'Input', False],
+            ['Surface Raster (DSM)', 'surface_raster', ['GPRasterLayer', 'GPRasterDataLayer', 'GPMapServerLayer', 'DEImageServer', 'GPMosaicLayer'], 'Required', 'Input', False],
+            ['Bare Earth Raster (DTM)', 'terrain_raster', ['GPRasterLayer', 'GPRasterDataLayer', 'GPMapServerLayer', 'DEImageServer', 'GPMosaicLayer'], 'Required', 'Input', False],
+            ['Cell Size (meters)', 'cell_size', 'GPLong', 'Required', 'Input', False],
+            ['Distance (meters)', 'distance', 'GPLong', 'Required', 'Input', True],
+            ['Bearing (degrees)', 'bearing', 'GPLong', 'Required', 'Input', True],
+            ['Interval (meters)', 'interval', 'GPLong', 'Required', 'Input', False],
+            ['Vertical Offset (meters)', 'vertical_offset', 'GPLong', 'Required', 'Input', True],
+            ['Raster Output', 'raster_output', 'DERasterDataset', 'Optional', 'Output', False],
+            ['Tile Size (cells)', 'tile_size', 'GPLong', 'Optional', 'Input', False],
+            ['Workers', 'workers', 'GPLong', 'Optional', 'Input', False],
+            ['Mil Thresholds', 'mil_thresholds', 'GPDouble', 'Optional', 'Input', True],
+            ['Sampling', 'sampling', 'GPString', 'Optional', 'Input', False],
+            ['Tile Cache Size (MB)', 'cache_size', 'GPLong', 'Optional', 'Input', False]
         ]
 
         params = [
@@ -51,7 +106,8 @@ class AreaMaxRiseOverRun(object):
                 name=d[1],
                 datatype=d[2],
                 parameterType=d[3],
-                direction=d[4]) for d in [p for p in pdata]]
+                direction=d[4],
+                multiValue=d[5]) for d in [p for p in pdata]]
 
         # Presets/Defaults
         params[0].filter.type = 'ValueList'
@@ -60,9 +116,15 @@ class AreaMaxRiseOverRun(object):
 
         params[1].filter.list = ['Polygon']
         params[4].value = 25  # Default cell size
-        params[5].value = 1000  # Default distance
+        params[5].values = [1000]  # Default distance
         params[7].value = 20  # Default interval
-        params[8].value = 2  # Default vertical offset
+        params[8].values = [2]  # Default vertical offset
+        params[10].value = 1024  # Default tile edge, bounds peak memory
+        params[11].value = os.cpu_count()  # Default one worker process per core
+        params[13].filter.type = 'ValueList'
+        params[13].filter.list = ['Nearest', 'Bilinear']
+        params[13].value = 'Nearest'  # Bilinear smooths profiles when the interval is finer than the DSM cells
+        params[14].value = 1024  # Default cache cap, 0 turns the cache off
 
         return params
 
@@ -89,252 +151,174 @@ class AreaMaxRiseOverRun(object):
         ur = ext.upperRight
         return Extent(ll.X, ll.Y, ur.X, ur.Y)
 
-    def copy_sample_values(self, source_lyr, target_lyr, target_field):
-        """
-        Method to avoid costly joins.  Extract join key and sample values to dict,
-        then use a da.UpdateCursor() to update target point feature class with
-        sampled raster values.
-        """
-        sample_vals = dict([(r[2], r[-1]) for r in arcpy.da.SearchCursor(source_lyr, '*')])
-        with arcpy.da.UpdateCursor(target_lyr, ['OID@', target_field]) as update_rows:
-            for row in update_rows:
-                row[1] = sample_vals[row[0]]
-                update_rows.updateRow(row)
-        del update_rows
-        return True
-
-    def curvature(self, sample_distance: int):
-        return 0.2032 * ((sample_distance / 1609) ** 2)
-
-    def calc_degs(self, dtm, dsm, distance, curvature, vo):
-        return atan(((dsm - curvature) - (dtm + vo)) / distance) * (180 / pi)
-
     def get_name(self, path):
         return os.path.splitext(os.path.split(path)[1])[0]
 
-    def deg_to_valid_mils(self, degs):
-        m = degs * (6400 / 360)
-        if (m > 1600) or (m < -1600):
-            return None
-        else:
-            return m
-
     def execute(self, parameters, messages):
         # Environments
         arcpy.env.overwriteOutput = True
         p = arcpy.mp.ArcGISProject('CURRENT')
         default_db = p.defaultGeodatabase
-        scratch = arcpy.env.scratchGDB
         
-        # Parameters
+        # Parameters.  Distance, bearing and vertical offset take several values
+        # for a sweep, which writes one band per combination.
         cellsize = parameters[4].value
-        distance = parameters[5].value
-        bearing = parameters[6].value
+        distances = parameters[5].values
+        bearings = parameters[6].values
         interval = parameters[7].value
-        vert_offset = parameters[8].value
-        
-        dsm = parameters[2].valueAsText
-        dtm = parameters[3].valueAsText
+        vert_offsets = parameters[8].values
+        thresholds = sorted(parameters[12].values or [])
+        method = (parameters[13].valueAsText or 'Nearest').lower()
+        tile_size = parameters[10].value or 1024
+        workers = parameters[11].value or 1
+        cache_mb = parameters[14].value or 0
+
+        # Worker processes cannot see map layers, so hand them dataset paths
+        dsm = arcpy.Describe(parameters[2].valueAsText).catalogPath
+        dtm = arcpy.Describe(parameters[3].valueAsText).catalogPath
 
         # Get spatial reference from input surface raster
         sr = arcpy.Describe(dsm).spatialReference
         arcpy.env.outputCoordinateSystem = sr
 
         ao_selection = parameters[0].valueAsText
+        ao_polys = None
         
         if ao_selection == 'By View Extent':
             ao_extent = self.get_view_extent()
             arcpy.AddMessage(f'Using view extent: {ao_extent}')
         else:
+            # Only cells inside the AO polygon(s) are evaluated
             poly_lyr = parameters[1].valueAsText
-            ao_poly = arcpy.Describe(poly_lyr).extent
-            ao_extent = Extent(ao_poly.XMin, ao_poly.YMin, ao_poly.XMax, ao_poly.YMax)
-            arcpy.AddMessage(f'Using {poly_lyr} extent: {ao_extent}')
-
-        # Generate fishnet and get center points
-        arcpy.SetProgressor('default', 'Generating sample points over deployment area...')
-        arcpy.CreateFishnet_management(
-            r'memory\fn',
-            f'{ao_extent.XMin} {ao_extent.YMin}',
-            f'{ao_extent.XMin} {ao_extent.YMax}',
-            cellsize,
-            cellsize,
-            corner_coord=f'{ao_extent.XMax} {ao_extent.YMax}'
-        )
-
-        ao_cell_centers = r'memory\fn_label'
-        arcpy.AddFields_management(
-            ao_cell_centers,
-            [['distance', 'LONG'],
-             ['bearing', 'LONG']]
-        )
-
-        # dtm_sampled will be the final table from which we will build the raster
-        arcpy.SetProgressor('default', 'Sampling bare earth dataset...')
-        dtm_sampled = Sample(
-            dtm,
-            ao_cell_centers,
-            r'memory\dtm_samp',
-            unique_id_field='OID',
-            generate_feature_class='FEATURE_CLASS'
-        )
-        
-        # Add the fields required to dtm_sampled
-        arcpy.AddFields_management(
-            dtm_sampled,
-            [['incline_deg', 'DOUBLE'],
-             ['incline_mil', 'DOUBLE']]
-        )
-        
-        """
-        dtm_sampled row now looks like:
-        
-        (OID, (SHAPE@XY), LOCATIONID, X, Y, <dtm name>, incline_deg, incline_mil)
-        """
-
-        arcpy.SetProgressor('default', 'Updating fields...')
-        with arcpy.da.UpdateCursor(ao_cell_centers, ['distance', 'bearing']) as cursor:
-            for row in cursor:
-                row[0] = distance
-                row[1] = bearing
-                cursor.updateRow(row)
-        del cursor
-
-        arcpy.AddXY_management(ao_cell_centers)
-
-        # Now construct lines of bearing from the table
-        # Switch location to os.path.join(scratch, 'az_lines') for debugging or memory failure
-        arcpy.SetProgressor('default', 'Building lines of bearing...')
-        az_lines = arcpy.BearingDistanceToLine_management(
-            ao_cell_centers,
-            r'memory\az_lines',
-            'POINT_X',
-            'POINT_Y',
-            distance_field='distance',
-            distance_units='METERS',
-            bearing_field='bearing',
-            spatial_reference=sr
-        )
-
-        """
-        Lines of bearing row should now look like this:
+            ao_polys = feature_polygons(poly_lyr, sr)
+            verts = np.concatenate([ring for rings in ao_polys for ring in rings])
+            ao_extent = Extent(verts[:, 0].min(), verts[:, 1].min(), verts[:, 0].max(), verts[:, 1].max())
+            arcpy.AddMessage(f'Using {len(ao_polys)} polygon(s) from {poly_lyr}, extent: {ao_extent}')
 
-        (OID, (SHAPE@), LOCATIONID, X, Y, <dsm name>, distance, bearing, ORIG_FID, Shape_Length)
-        """
-
-        # Build points along line at fixed intervals
-        # Switch output to os.path.join(scratch, 'samplepoints') for debugging or memory failure
-        arcpy.SetProgressor('default', 'Creating sample points along lines...')
-        samplepoints = arcpy.GeneratePointsAlongLines_management(
-            az_lines,
-            os.path.join(scratch, 'samplepoints'),
-            'DISTANCE',
-            Distance=f'{interval} meters',
-            Include_End_Points='END_POINTS'
-        )
-        arcpy.AddXY_management(samplepoints)
-
-        # Sample the DSM
-        arcpy.SetProgressor('default', 'Sampling surface dataset...')
-        # Switch output to os.path.join(scratch, 'dsm_sam') for debugging or memory failure
-        dsm_sampled = Sample(dsm, samplepoints, os.path.join(scratch, 'dsm_sam'),
-                             generate_feature_class='FEATURE_CLASS')
-
-        # Add from_origin, dsm, and curvature to samplepoints
-        arcpy.SetProgressor('default', 'Adding analysis fields to sampled points...')
-        arcpy.AddFields_management(
-            samplepoints,
-            [['from_origin', 'FLOAT'],
-             ['dsm', 'FLOAT'],
-             ['curvature', 'DOUBLE']])
-
-        """
-        Update each point's distance from origin as a member of its ORIG_FID group.
-        This will be used to calculate curvature value.
-        
-        Copy over the DSM sample values to samplepoints.
-        """
-        c = defaultdict(list)
-        arcpy.SetProgressor('default', "Calculating each point's curvature and distance from origin...")
-        with arcpy.da.SearchCursor(samplepoints, ['OID@', 'ORIG_FID', 'from_origin']) as sc:
-            for row in sc:
-                c[row[1]].append(row)
-        c = json.loads(json.dumps(c))
-        del sc
-
-        # Calculate distance to origin for each point grouped by ORIG_FID
-        sp_with_intervals = {int(k): [(a, b, interval * i) for i, (a, b, c) in enumerate(v)] for k, v in c.items()}
-        
-        with arcpy.da.UpdateCursor(samplepoints, ['OID@', 'ORIG_FID', 'from_origin', 'curvature']) as uc:
-            for u_row in uc:
-                if u_row[1] in sp_with_intervals.keys():
-                    for n_row in sp_with_intervals[u_row[1]]:
-                        if n_row[0] == u_row[0]:  # Check OID alignment
-                            u_row[2] = n_row[2]
-                            u_row[3] = self.curvature(sample_distance=u_row[2])
-                uc.updateRow(u_row)
-        del uc
-        
-        # Copy over DSM sampled values to samplepoints
-        self.copy_sample_values(dsm_sampled, samplepoints, 'dsm')
-
-        """
-        Row in samplepoints now looks like:
-
-        (OID, (SHAPE@XY), ORIG_FID, POINT_X, POINT_Y, DISTANCE, BEARING, SHAPE_LENGTH, FROM_ORIGIN, DSM, CURVATURE)
-        """
-        
-        # Calculate the inclination of each point between the dtm_sampled (origin) and samplepoints
-        # Set up the cursors
-
-        s = defaultdict(list)
-        
-        with arcpy.da.SearchCursor(samplepoints, ['ORIG_FID', 'from_origin', 'dsm', 'curvature']) as sp_cursor:
-            for row in sp_cursor:
-                s[row[0]].append(row)
-        del sp_cursor
-
-        samps = dict((k, [i for i in v if i[1] > 0]) for k, v in s.items())
-
-        with arcpy.da.UpdateCursor(dtm_sampled, '*') as dtm_cursor:
-            for row in dtm_cursor:
-                loc_id = row[2]
-                dtm_val = row[5]
-                if loc_id in samps.keys():
-                    i = []
-                    s_points = samps[loc_id]
-                    for sp in s_points:
-                        d = sp[1]
-                        c = sp[3]
-                        dsm_val = sp[2]
-                        try:
-                            inclination = self.calc_degs(dtm_val, dsm_val, d, c, vert_offset)
-                            i.append(inclination)
-                        except TypeError:  # This covers distances not covered by surface raster
-                            i.append(-9999)
-                    max_inclination = max(i)
-                    row[6] = max_inclination
-                    row[7] = self.deg_to_valid_mils(max_inclination)
-                dtm_cursor.updateRow(row)
-        del dtm_cursor
-
-        # Now create the final output raster from the points based on inclination
-        arcpy.SetProgressor('default', 'Writing out inclination raster...')
-        
         if parameters[9].valueAsText:
             out_raster = parameters[9].valueAsText
         else:
+            single = len(bearings) == len(distances) == len(vert_offsets) == 1
+            prefix = f'Incl_{bearings[0]}_' if single else 'Incl_Sweep_'
+            if thresholds:
+                prefix = prefix.replace('Incl_', 'InclClass_')
             out_raster = os.path.join(default_db, arcpy.CreateScratchName(
-                prefix=f'Incl_{bearing}_',
+                prefix=prefix,
                 suffix='',
                 data_type='RasterDataset'))
 
-        incl_raster = arcpy.PointToRaster_conversion(
-            dtm_sampled,
-            'incline_mil',
-            out_raster,
-            cell_assignment='MEAN',
-            cellsize=cellsize
-        )
+        # Work through the AO a tile at a time.  Each tile reads its own DTM
+        # window and a DSM window grown by the ray reach, so peak memory follows
+        # the tile size rather than the AO size.  Tiles are independent and are
+        # farmed out to worker processes, then written back in tile order so the
+        # output does not depend on the number of workers.  The output grid is
+        # snapped to whole cells from the coordinate origin, cached or not, so
+        # cached and uncached runs line up cell for cell.
+        ao_grid = Grid.from_extent(floor(ao_extent.XMin / cellsize) * cellsize,
+                                   floor(ao_extent.YMin / cellsize) * cellsize,
+                                   ao_extent.XMax, ao_extent.YMax, cellsize)
+        if cache_mb:
+            # Cached blocks are tiles of the user's tile size on a lattice snapped
+            # to the coordinate origin, so runs over overlapping areas with the
+            # same tile size share them.  Only the AO cells of a block are
+            # computed; each block is cached with a mask of the cells it holds
+            # and later runs compute just the cells missing.
+            span = cellsize * tile_size
+            grid = Grid.from_extent(floor(ao_grid.x_min / span) * span, floor(ao_grid.y_min / span) * span,
+                                    ceil(ao_grid.x_max / span) * span, ceil(ao_grid.y_max / span) * span, cellsize)
+            tiles = list(grid.tiles(tile_size))
+            cache = TileCache('amror_cache', cache_mb)
+            identity = dict(dsm=dataset_stamp(dsm), dtm=dataset_stamp(dtm), cellsize=cellsize,
+                            bearings=bearings, distances=distances, interval=interval,
+                            vert_offsets=vert_offsets, thresholds=thresholds, method=method)
+        else:
+            grid = ao_grid
+            tiles = list(grid.tiles(tile_size))
+            cache = None
+        args = (dsm, dtm, bearings, distances, vert_offsets, interval, thresholds, method)
+        nodata = CLASS_NODATA if thresholds else np.nan
+        jobs = []
+        order = []
+        keys = {}
+        masks = {}
+        cached = {}
+        for number, tile in enumerate(tiles):
+            overlap = tile.overlap(ao_grid)
+            if overlap is None:
+                continue
+            mask = None
+            if cache:  # Cells of a lattice block outside the AO are left alone
+                mask = np.zeros(tile.shape, dtype=bool)
+                mask[overlap] = True
+            if ao_polys:  # Tiles that miss every AO polygon are skipped entirely
+                inside = burn_polygons(ao_polys, tile) > 0
+                mask = inside if mask is None else mask & inside
+                if not mask.any():
+                    continue
+            order.append(number)
+            masks[number] = mask
+            if cache:
+                keys[number] = cache.key(tile=(tile.x_min, tile.y_max, tile.nrows, tile.ncols), **identity)
+                # Only the small validity masks are read up front; values are read
+                # as each block is written so memory stays bounded
+                valid = cache.get(keys[number] + '_valid') if keys[number] in cache else None
+                if valid is not None:
+                    cached[number] = valid
+                    mask = mask & ~valid
+                    if not mask.any():
+                        continue
+                if mask.all():
+                    mask = None
+            jobs.append((number, tile, mask, args))
+        if not order:
+            arcpy.AddWarning('The AO polygons do not cover any cells.')
+            return None
+
+        combos = amror_core.combinations(bearings, distances, vert_offsets)
+        writer = TileWriter(out_raster, nodata)
+        timings = {}
+        if cache:
+            arcpy.AddMessage(f'{len(order) - len(jobs)} of {len(order)} blocks found whole in the tile cache')
+        arcpy.AddMessage(f'Processing {len(jobs)} tiles with {max(1, min(workers, len(jobs)))} worker(s)')
+        arcpy.SetProgressor('step', 'Calculating maximum inclination...', 0, len(order), 1)
+        results = ordered_map(inclination_job, jobs, min(workers, len(jobs)))
+        computed = {job[0]: job[2] for job in jobs}  # Tile number: mask of the cells computed
+        for number in order:
+            tile = tiles[number]
+            if number in computed:
+                _, incl_mils, _, seconds = next(results)
+                timings[number] = seconds
+                if cache:
+                    done = np.ones(tile.shape, dtype=bool) if computed[number] is None else computed[number]
+                    values = cache.get(keys[number]) if number in cached else None
+                    if values is not None:
+                        incl_mils = np.where(cached[number], values, incl_mils)
+                        done = done | cached[number]
+                    elif number in cached:  # Evicted by this run's own writes
+                        incl_mils, _ = inclination_tile(tile, masks[number], *args)
+                        done = np.ones(tile.shape, dtype=bool) if masks[number] is None else masks[number]
+                    cache.put(keys[number], incl_mils)
+                    cache.put(keys[number] + '_valid', done)
+            else:
+                incl_mils = cache.get(keys[number])
+                if incl_mils is None:  # Evicted by this run's own writes
+                    incl_mils, _ = inclination_tile(tile, masks[number], *args)
+            if masks[number] is not None:
+                incl_mils[..., ~masks[number]] = nodata
+            rows, cols = tile.overlap(ao_grid)
+            out_tile = tile.subgrid(rows.start, cols.start, rows.stop - rows.start, cols.stop - cols.start)
+            writer.write(incl_mils[..., rows, cols], out_tile)
+            arcpy.SetProgressorPosition()
+        if timings:
+            arcpy.AddMessage(timing_summary(timings))
+        if thresholds:
+            bounds = ', '.join(f'{t:g}' for t in thresholds)
+            arcpy.AddMessage(f'Class n: at or above the nth of {bounds} mils (0 below all of them)')
+
+        if len(combos) > 1:
+            for band, (b, d, vo) in enumerate(combos, 1):
+                arcpy.AddMessage(f'Band_{band}: bearing {b}, distance {d}, vertical offset {vo}')
+
+        incl_raster = writer.out_raster
         
         return incl_raster
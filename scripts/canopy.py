@@ -6,28 +6,40 @@ import sys
 
 sys.dont_write_bytecode = True
 
+from scripts.utils.align import common_grid, read_aligned
+from scripts.utils.arcarray import TileWriter, raster_grid, read_window, save_array
+from scripts.utils.chm_core import MIN_HEIGHT, canopy_height, fill_nearest
+from scripts.utils.grid import Grid
+from scripts.utils.las import surface_grids
+from scripts.utils.trees import MAX_HEIGHT, canopy_cover, crown_radius, crown_stats, grow_crowns, tree_tops
+
 
 class CHM(object):
 
     def __init__(self):
         """
-        Derives canopy height model (CHM) from two rasters (current)
-        or point cloud (TBD) data.
+        Derives canopy height model (CHM) from two rasters or from an
+        uncompressed LAS point cloud.
         """
         self.category = 'Analysis'
         self.name = 'CHM'
         self.label = 'Calculate Canopy Height Model'
         self.alias = 'Calculate Canopy Height Model'
-        self.description = 'Calculate canopy height model from two terrain data sources.'
+        self.description = 'Calculate canopy height model from two terrain data sources or a LAS point cloud.'
         self.canRunInBackground = False
 
     def getParameterInfo(self):
 
         pdata = [
-            ['Surface Model (DSM)', 'surface_model', ['DERasterDataset', 'GPRasterLayer'], 'Required', 'Input', None],
-            ['Bare Earth Model (DTM)', 'bare_earth_model', ['DERasterDataset', 'GPRasterLayer'], 'Required', 'Input', None],
+            ['Surface Model (DSM)', 'surface_model', ['DERasterDataset', 'GPRasterLayer'], 'Optional', 'Input', None],
+            ['Bare Earth Model (DTM)', 'bare_earth_model', ['DERasterDataset', 'GPRasterLayer'], 'Optional', 'Input', None],
             ['Output Name', 'output_name', 'GPString', 'Optional', 'Input', None],
-            ['Run in memory?', 'run_in_memory', 'GPBoolean', 'Required', 'Input', 'Advanced Options']
+            ['Run in memory?', 'run_in_memory', 'GPBoolean', 'Required', 'Input', 'Advanced Options'],
+            ['Block Size (cells)', 'block_size', 'GPLong', 'Optional', 'Input', 'Advanced Options'],
+            ['Point Cloud (LAS)', 'point_cloud', 'DEFile', 'Optional', 'Input', 'Point Cloud'],
+            ['Cell Size', 'cell_size', 'GPDouble', 'Optional', 'Input', 'Point Cloud'],
+            ['Point Cloud Coordinate System', 'point_cloud_sr', 'GPSpatialReference', 'Optional', 'Input', 'Point Cloud'],
+            ['DTM Resampling', 'dtm_resampling', 'GPString', 'Optional', 'Input', 'Advanced Options']
         ]
 
         params = [
@@ -40,6 +52,12 @@ class CHM(object):
                 category=d[5]) for d in [p for p in pdata]]
         
         params[3].value = True
+        params[4].value = 2048
+        params[5].filter.list = ['las']
+        params[6].value = 1.0
+        params[8].filter.type = 'ValueList'
+        params[8].filter.list = ['Nearest', 'Bilinear']
+        params[8].value = 'Bilinear'
         
         return params
     
@@ -50,11 +68,12 @@ class CHM(object):
         return True
     
     def updateMessages(self, parameters):
+        if not parameters[5].value:
+            for p in parameters[:2]:
+                if not p.value:
+                    p.setErrorMessage('A surface and bare earth model are required without a point cloud.')
         return True
     
-    def subtract_array(self, array1, array2):
-        return array1 - array2
-    
     def execute(self, parameters, messages):
         arcpy.CheckOutExtension('Spatial')
         arcpy.env.overwriteOutput = True
@@ -63,38 +82,52 @@ class CHM(object):
         db = p.defaultGeodatabase
         m = p.activeMap
 
-        dsm = parameters[0].valueAsText
-        r = arcpy.Raster(dsm)
-        cell_size_x = r.meanCellWidth
-        cell_size_y = r.meanCellHeight
-
-        dsm_ll = arcpy.Describe(dsm).Extent.lowerLeft
-        dtm = parameters[1].valueAsText
-        out_raster = os.path.join(db, parameters[2].valueAsText)
+        las = parameters[5].valueAsText
+        if not las and not (parameters[0].value and parameters[1].value):
+            arcpy.AddError('A surface and bare earth model are required without a point cloud.')
+            raise arcpy.ExecuteError
+        if parameters[2].valueAsText:
+            out_raster = os.path.join(db, parameters[2].valueAsText)
+        else:
+            out_raster = os.path.join(db, arcpy.CreateScratchName(prefix='CHM_', suffix='', data_type='RasterDataset'))
         mem = parameters[3].value
+        block_size = parameters[4].value or 2048
 
-        if mem:
-            # Use numpy arrays for great speed...
+        if las:
+            # One streaming pass bins first returns and ground returns; cells
+            # with no ground under the canopy take the nearest ground cell
+            if parameters[7].value:
+                arcpy.env.outputCoordinateSystem = parameters[7].value
+            arcpy.SetProgressor('default', 'Gridding point cloud...')
+            grid, surface, ground = surface_grids(las, parameters[6].value or 1.0)
+            if np.isnan(ground).all():
+                arcpy.AddWarning('The point cloud has no ground (class 2) returns.')
+            save_array(canopy_height(surface, fill_nearest(ground)), grid, out_raster)
+        elif mem:
+            # Use numpy arrays for great speed, a block at a time so memory
+            # follows the block size rather than the raster size.  The output
+            # is on the DSM's cells where both rasters overlap and the DTM is
+            # resampled onto them block by block...
+            dsm = arcpy.Describe(parameters[0].valueAsText).catalogPath
+            dtm = arcpy.Describe(parameters[1].valueAsText).catalogPath
+            method = (parameters[8].valueAsText or 'Bilinear').lower()
             arcpy.env.outputCoordinateSystem = dsm
-            arcpy.SetProgressor('default', 'Converting rasters to arrays...')
-            dsm_arr = arcpy.RasterToNumPyArray(dsm, nodata_to_value=0)
-            dtm_arr = arcpy.RasterToNumPyArray(dtm, nodata_to_value=0)
-            arcpy.SetProgressor('default', 'Doing math...')
-            diff_arr = dsm_arr - dtm_arr
-            diff_arr[np.where(diff_arr < 1.8)] = 0
-            diff = arcpy.NumPyArrayToRaster(
-                diff_arr,
-                dsm_ll,
-                cell_size_x,
-                cell_size_y,
-                value_to_nodata=0)
-            diff.save(out_raster)
+            grid = common_grid(dsm, dtm)
+            blocks = list(grid.tiles(block_size))
+            writer = TileWriter(out_raster)
+            arcpy.SetProgressor('step', 'Calculating canopy height...', 0, len(blocks), 1)
+            for block in blocks:
+                surface = read_aligned(dsm, block).array
+                bare = read_aligned(dtm, block, method).array
+                writer.write(canopy_height(surface, bare), block)
+                arcpy.SetProgressorPosition()
         else:
             # ...or raster calculator for great stability
             arcpy.SetProgressor('default', 'Doing raster math...')
+            dsm, dtm = parameters[0].valueAsText, parameters[1].valueAsText
             diff_calc = RasterCalculator([dsm, dtm], ['surface', 'bare'], 'surface-bare')
             arcpy.SetProgressor('default', 'Setting null values...')
-            diff = SetNull(diff_calc, diff_calc, 'Value < 1.8')
+            diff = SetNull(diff_calc, diff_calc, f'Value < {MIN_HEIGHT}')
             diff.save(out_raster)
 
         chm_lyr = m.addDataFromPath(out_raster)
@@ -105,3 +138,118 @@ class CHM(object):
         sym.colorizer.colorRamp = p.listColorRamps('Condition Number')[0]
         sym.colorizer.noDataColor = {'RGB': [0, 0, 0, 0]}
         chm_lyr.symbology = sym
+
+
+class TreeCrowns(object):
+
+    def __init__(self):
+        """
+        Finds individual tree tops and crowns in a canopy height model and
+        grids canopy cover, a tile at a time.
+        """
+        self.category = 'Analysis'
+        self.name = 'TreeCrowns'
+        self.label = 'Tree Tops and Canopy Cover'
+        self.alias = 'Tree Tops and Canopy Cover'
+        self.description = 'Find tree tops, crown heights and areas, and percent canopy cover from a CHM.'
+        self.canRunInBackground = False
+
+    def getParameterInfo(self):
+
+        pdata = [
+            ['Canopy Height Model', 'chm', ['DERasterDataset', 'GPRasterLayer'], 'Required', 'Input', None],
+            ['Minimum Tree Height', 'min_height', 'GPDouble', 'Optional', 'Input', None],
+            ['Cover Cell Size', 'cover_cell_size', 'GPDouble', 'Optional', 'Input', None],
+            ['Output Tree Tops', 'out_tops', 'GPString', 'Optional', 'Input', None],
+            ['Output Canopy Cover', 'out_cover', 'GPString', 'Optional', 'Input', None],
+            ['Tile Size (cells)', 'tile_size', 'GPLong', 'Optional', 'Input', 'Advanced Options']
+        ]
+
+        params = [
+            arcpy.Parameter(
+                displayName=d[0],
+                name=d[1],
+                datatype=d[2],
+                parameterType=d[3],
+                direction=d[4],
+                category=d[5]) for d in [p for p in pdata]]
+
+        params[1].value = MIN_HEIGHT
+        params[2].value = 10
+        params[5].value = 2048
+
+        return params
+
+    def isLicensed(self):
+        return True
+
+    def updateParameters(self, parameters):
+        return True
+
+    def updateMessages(self, parameters):
+        return True
+
+    def execute(self, parameters, messages):
+        arcpy.env.overwriteOutput = True
+
+        p = arcpy.mp.ArcGISProject('CURRENT')
+        db = p.defaultGeodatabase
+        m = p.activeMap
+
+        chm = arcpy.Describe(parameters[0].valueAsText).catalogPath
+        min_height = parameters[1].value or MIN_HEIGHT
+        out_tops = os.path.join(db, parameters[3].valueAsText or arcpy.CreateScratchName(
+            prefix='TreeTops_', suffix='', data_type='FeatureClass'))
+        out_cover = os.path.join(db, parameters[4].valueAsText or arcpy.CreateScratchName(
+            prefix='CanopyCover_', suffix='', data_type='RasterDataset'))
+
+        sr = arcpy.Describe(chm).spatialReference
+        arcpy.env.outputCoordinateSystem = sr
+        grid = raster_grid(chm)
+        cell = min(grid.cell_w, grid.cell_h)
+        factor = max(1, int(round((parameters[2].value or 10) / cell)))
+        # Tiles are whole cover cells so each cover cell is summed in one tile
+        tile_size = -(-(parameters[5].value or 2048) // factor) * factor
+        tiles = list(grid.tiles(tile_size))
+
+        # Tiles read enough CHM around them that a crown of the tallest
+        # plausible tree whose top is in the tile is whole
+        pad = int(np.ceil(2 * crown_radius(MAX_HEIGHT) / cell))
+
+        tops_fc = arcpy.CreateFeatureclass_management(db, os.path.basename(out_tops), 'POINT', spatial_reference=sr)
+        fields = [
+            ['HEIGHT', 'DOUBLE'],
+            ['CROWN_AREA', 'DOUBLE'],
+            ['CROWN_DIAM', 'DOUBLE']]
+        arcpy.AddFields_management(tops_fc, fields)
+        cover_writer = TileWriter(out_cover)
+
+        count = 0
+        arcpy.SetProgressor('step', 'Finding tree tops...', 0, len(tiles), 1)
+        with arcpy.da.InsertCursor(tops_fc, ['SHAPE@XY'] + [f[0] for f in fields]) as cursor:
+            for tile in tiles:
+                win = read_window(chm, *tile.extent, pad=pad)
+                core = win.grid.overlap(tile)
+                tops = tree_tops(win.array, cell, min_height)
+                crowns = grow_crowns(win.array, tops, min_height)
+                height, area = crown_stats(win.array, crowns, win.grid.cell_w * win.grid.cell_h)
+
+                # Only tops inside the tile proper are kept, so tiles do not repeat trees
+                rows, cols = np.nonzero(tops)
+                keep = ((rows >= core[0].start) & (rows < core[0].stop) &
+                        (cols >= core[1].start) & (cols < core[1].stop))
+                xs, ys = win.grid.centers()
+                diameter = 2 * np.sqrt(area / np.pi)
+                for x, y, h, a, d in zip(xs[cols[keep]], ys[rows[keep]], height[keep], area[keep], diameter[keep]):
+                    cursor.insertRow(((x, y), h, a, d))
+                count += int(keep.sum())
+
+                cover = canopy_cover(win.array[core], factor, min_height)
+                cover_grid = Grid(tile.x_min, tile.y_max, tile.cell_w * factor, tile.cell_h * factor, *cover.shape)
+                cover_writer.write(cover, cover_grid)
+                arcpy.SetProgressorPosition()
+        del cursor
+
+        arcpy.AddMessage(f'{count} tree tops found')
+        m.addDataFromPath(tops_fc)
+        m.addDataFromPath(out_cover)
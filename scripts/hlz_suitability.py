@@ -5,7 +5,9 @@ raster (optional), vertical obstructions (optional) and landing zone candidates
 as a Point layer (optional).
 
 The user selects a helicopter platform and the data is analyzed and reclassified
-to show possible landing zone candidates.
+to show possible landing zone candidates.  Connected Pass regions can then be
+turned into ranked landing zone points, one point feature class per platform,
+and candidate points are scored against each platform's clearance disk.
 
 @Author: Bryan Huddleston
 @Date: October 2023
@@ -14,13 +16,22 @@ to show possible landing zone candidates.
 """
 
 import arcpy
-from arcpy.sa import Combine, Reclassify, SurfaceParameters, RemapRange, RemapValue
 import json
+import numpy as np
 import os
 import sys
 
 sys.dont_write_bytecode = True
 
+from scripts.utils.align import read_aligned
+from scripts.utils.arcarray import TileWriter, feature_parts, feature_points, feature_polygons, raster_grid, read_window
+from scripts.utils.lz import ComponentTiles, inscribed_radius, rank
+from scripts.utils.hlz_core import (CLASS_NODATA, classify, compile_reclass, compile_remap, composite, disk_stencil,
+	disk_summary, horn_slope, remap, remap_nodata)
+from scripts.utils.tilecache import TileCache, dataset_stamp
+from scripts.utils.obstruction import (burn_obstructions, clearance_classes, clearance_margin, obstruction_distance,
+	parse_distance)
+
 
 # Globals
 def get_config():
@@ -32,6 +43,25 @@ def get_config():
 CFG = get_config()
 PLATFORMS = CFG["platforms"]
 REMAPS = CFG["remaps"]
+TILE_SIZE = 1024  # Cells per tile edge, bounds peak memory
+
+
+def tile_slope(dem_path, block, cache=None):
+	"""
+	Slope of one DEM lattice block, from the tile cache when it has been
+	computed before.  Blocks sit at fixed multiples of TILE_SIZE from the DEM
+	origin, so a block's slope does not depend on the extent being processed.
+	"""
+	key = cache.key(dem=dataset_stamp(dem_path), block=(block.x_min, block.y_max, block.nrows, block.ncols)) if cache else None
+	slope = cache.get(key) if cache else None
+	if slope is None:
+		# One cell of padding gives the edge cells real neighbours
+		dem_win = read_window(dem_path, *block.extent, pad=1)
+		slope = horn_slope(dem_win.array, dem_win.grid.cell_w, dem_win.grid.cell_h)[dem_win.grid.overlap(block)]
+		slope = slope.astype(np.float32)
+		if cache:
+			cache.put(key, slope)
+	return slope
 
 
 class HLZSuitability(object):
@@ -89,6 +119,20 @@ class HLZSuitability(object):
 			parameterType='Required',
 			direction='Input')
 		
+		param6 = arcpy.Parameter(
+			displayName='Extract Landing Zones',
+			name='extract_lz',
+			datatype='GPBoolean',
+			parameterType='Optional',
+			direction='Input')
+
+		param7 = arcpy.Parameter(
+			displayName='Tile Cache Size (MB)',
+			name='cache_size',
+			datatype='GPLong',
+			parameterType='Optional',
+			direction='Input')
+
 		param1.filter.type = 'ValueList'
 		# This way you can just add new platforms and their processing settings in
 		# hlz_config.json and the script tool will automatically pick them up:
@@ -98,7 +142,10 @@ class HLZSuitability(object):
 		param5.filter.list = ['View Extent', 'Terrain coverage extent']
 		param5.value = 'View Extent'
 
-		params = [param0, param1, param2, param3, param4, param5]
+		param6.value = True
+		param7.value = 1024  # Default cache cap, 0 turns the cache off
+
+		params = [param0, param1, param2, param3, param4, param5, param6, param7]
 
 		return params
 
@@ -150,6 +197,8 @@ class HLZSuitability(object):
 		lulc = parameters[2].valueAsText
 		vert = parameters[3].valueAsText
 		points = parameters[4].valueAsText
+		extract_lz = parameters[6].value
+		cache_mb = parameters[7].value or 0
 
 		proc_area = parameters[5].valueAsText
 		if proc_area == 'View Extent':
@@ -158,93 +207,107 @@ class HLZSuitability(object):
 			)
 		else:
 			arcpy.env.extent = dem
-
-		# Process Slope
-		arcpy.SetProgressor('default', 'Calculating Slope...')
-		slope_hlz = SurfaceParameters(
-			in_raster=dem,
-			parameter_type='SLOPE',
-			output_slope_measurement='DEGREE')
-		arcpy.AddMessage('Created slope...')
-
-		# Storing outputs in a dictionary makes it easier to do
-		# conditional processing later
-		rasters = {
-			"slopes": [],
-			"optional": {
-				"land_cover": None,
-				"vertical_obstructions": None
-			}
-		}
+		ext = arcpy.env.extent if proc_area == 'View Extent' else arcpy.Describe(dem).extent
+		arcpy.env.outputCoordinateSystem = arcpy.Describe(dem).spatialReference
 
 		for plt in plts:
-			arcpy.AddMessage(f"PLATFORM: {plt}")
-			arcpy.AddMessage("RECLASS VALUES FOR PLATFORM")
-			arcpy.AddMessage(f'{PLATFORMS[plt]["reclass"]}')
-			print(type(PLATFORMS[plt]["reclass"]))
-			try:
-				rm = RemapRange(PLATFORMS[plt]["reclass"])
-				arcpy.AddMessage(rm)
-				arcpy.AddMessage(type(rm))
-			except Exception as e:
-				arcpy.AddMessage("CAUGHT EXCEPTION!")
-				arcpy.AddMessage(e)
-				raise Exception
-				
-			reclassed_slope = Reclassify(
-				slope_hlz,
-				"VALUE",
-				RemapRange(PLATFORMS[plt]["reclass"]),
-				"NODATA"
-			)
-			reclassed_slope.save(PLATFORMS[plt]["shortname"])
-			rasters['slopes'].append(reclassed_slope)
+			arcpy.AddMessage(f'PLATFORM: {plt}, reclass {PLATFORMS[plt]["reclass"]}')
+		breaks, lut = compile_reclass([PLATFORMS[plt]["reclass"] for plt in plts])
+		clearances = [parse_distance(PLATFORMS[plt]["clearance"]) for plt in plts]
 
+		# Optional layers become per-cell classes through the same lookups, as
+		# (raster, function from cell values to classes) pairs
+		extras = []
 		if lulc:
-			arcpy.SetProgressor('default', 'Adding landcover data...')
 			arcpy.AddMessage('Adding landcover data.')
-			land_fact = Reclassify(lulc, 'VALUE', RemapValue(REMAPS["lulc"]), 'NODATA')
-			land_fact.save("HLZ_LULC")
-			rasters['optional']['land_cover'] = land_fact
-		
+			lulc_keys, lulc_classes = compile_remap(REMAPS["lulc"])
+			extras.append((
+				arcpy.Describe(lulc).catalogPath,
+				lambda values: remap(values, lulc_keys, lulc_classes, remap_nodata(REMAPS["lulc"]))))
+
+		# Obstructions are burned onto each tile's cells and every platform's
+		# clearance radius is checked against one distance transform
+		obstacles = None
 		if vert:
 			arcpy.SetProgressor('default', 'Adding vertical obstructions...')
 			arcpy.AddMessage('Adding vertical obstructions.')
-			vert_ras = arcpy.FeatureToRaster_conversion(vert, 'OBJECTID', 'obs_ras', cell_size=5)
-			vert_obs = Reclassify(vert_ras, 'VALUE', RemapRange(REMAPS["vobs"]))
-			vert_obs.save("OBS_RAS")
-			rasters['optional']['vertical_obstructions'] = vert_obs
-
-		options = rasters['optional']
-		extras_list = [i for i in options.values() if i]
-		field_list = [f'!{arcpy.Describe(v).name}!' for v in options.values() if v]
-		outputs = []
-		combos = []
-		if any(extras_list):
-			for slope in rasters['slopes']:
-				combine_inputs = [slope] + [extras_list]
-				hlz_combo = Combine(combine_inputs)
-				hlz_combo.save(f'{slope}_enhanced')
-				combos.append(hlz_combo)
-
-			for c in combos:
-				arcpy.SetProgressor('Final classification...')
-				arcpy.AddField_management(c, 'HLZ_Stat', 'LONG')
-				express = f'HighNum({field_list})'
-				code_block = """def HighNum(lst): return max(lst)"""
-				combo_reclass = arcpy.CalculateField_management(c, 'HLZ_Stat', express, 'PYTHON3', code_block)
-				outputs.append(combo_reclass)
+			sr = arcpy.Describe(dem).spatialReference
+			shape_type = arcpy.Describe(vert).shapeType
+			if shape_type in ('Point', 'Multipoint'):
+				obstacles = {'points': feature_points(vert, sr)}
+			elif shape_type == 'Polyline':
+				obstacles = {'lines': [part for parts in feature_parts(vert, sr) for part in parts]}
+			else:
+				obstacles = {'polygons': feature_polygons(vert, sr)}
+			fringe_factor = CFG["obstructions"]["fringe_factor"]
+
+		# Work through the DEM a tile at a time.  Slope classes for every platform
+		# go to one band per platform; with land cover or obstructions each platform
+		# also gets its own composite, the per-cell worst case of all its classes.
+		# Tiles are the parts of fixed DEM lattice blocks inside the extent, and
+		# the slope of each block is cached, so a rerun over the same ground with
+		# other platforms only reclassifies.
+		dem_path = arcpy.Describe(dem).catalogPath
+		native = raster_grid(dem_path)
+		row0, col0, row1, col1 = native.snapped_window(ext.XMin, ext.YMin, ext.XMax, ext.YMax)
+		row0, col0 = max(row0, 0), max(col0, 0)
+		row1, col1 = min(row1, native.nrows), min(col1, native.ncols)
+		grid = native.subgrid(row0, col0, row1 - row0, col1 - col0)
+		tiles = []  # (block row, block column), lattice block, part inside the extent
+		for r in range(row0 // TILE_SIZE * TILE_SIZE, row1, TILE_SIZE):
+			for c in range(col0 // TILE_SIZE * TILE_SIZE, col1, TILE_SIZE):
+				block = native.subgrid(r, c, min(TILE_SIZE, native.nrows - r), min(TILE_SIZE, native.ncols - c))
+				rows, cols = block.overlap(grid)
+				tile = block.subgrid(rows.start, cols.start, rows.stop - rows.start, cols.stop - cols.start)
+				tiles.append(((r // TILE_SIZE, c // TILE_SIZE), block, tile))
+		cache = TileCache('hlz_cache', cache_mb) if cache_mb else None
+
+		stack = TileWriter(os.path.join(db, 'HLZ_Slope_Classes'), CLASS_NODATA)
+		enhanced = [TileWriter(os.path.join(db, f'{PLATFORMS[plt]["shortname"]}_enhanced'), CLASS_NODATA)
+			for plt in plts] if extras or obstacles else []
+
+		arcpy.SetProgressor('step', 'Calculating slope classes...', 0, len(tiles), 1)
+		for _, block, tile in tiles:
+			slope = tile_slope(dem_path, block, cache)[block.overlap(tile)]
+			slope_classes = classify(slope, breaks, lut)
+			stack.write(slope_classes if len(plts) > 1 else slope_classes[0], tile)
+
+			if enhanced:
+				# Land cover is categorical, so it is aligned to the DEM cells by nearest cell
+				extra_classes = [to_classes(read_aligned(path, tile, 'nearest').array) for path, to_classes in extras]
+				obstruction_classes = [[]] * len(plts)
+				if obstacles:
+					# Pad the tile so obstructions just past its edge still count
+					margin = clearance_margin(tile, max(clearances) * fringe_factor)
+					padded = tile.subgrid(-margin, -margin, tile.nrows + 2 * margin, tile.ncols + 2 * margin)
+					distance = obstruction_distance(burn_obstructions(padded, **obstacles), padded)
+					distance = distance[margin:-margin, margin:-margin]
+					obstruction_classes = [[clearance_classes(distance, c, c * fringe_factor)] for c in clearances]
+				for writer, classes, obstruction in zip(enhanced, slope_classes, obstruction_classes):
+					writer.write(composite(classes, *extra_classes, *obstruction), tile)
+			arcpy.SetProgressorPosition()
+
+		for band, plt in enumerate(plts, 1):
+			arcpy.AddMessage(f'Band_{band}: {PLATFORMS[plt]["shortname"]}')
+		if enhanced:
+			outputs = [writer.out_raster for writer in enhanced]
+		elif len(plts) > 1:
+			outputs = [os.path.join(stack.out_raster, f'Band_{band}') for band in range(1, len(plts) + 1)]
 		else:
-			outputs = rasters['slopes']
+			outputs = [stack.out_raster]
+
+		if extract_lz:
+			self.extract_landing_zones(plts, outputs, clearances, dem_path, tiles, cache, db, m)
 
 		# Symbolize
 		arcpy.SetProgressor('default', 'Applying symbology...')
-		for o in outputs:
+		for plt, o in zip(plts, outputs):
 			lyr = m.addDataFromPath(o)
-			lyr.name = arcpy.Describe(o).name
+			lyr.name = PLATFORMS[plt]["shortname"] + ('_enhanced' if enhanced else '')
 			sym = lyr.symbology
 			sym.updateColorizer('RasterClassifyColorizer')
-			sym.colorizer.classificationField = [field.name for field in arcpy.ListFields(lyr) if field.name in ['HLZ_Stat', 'Value']][0]
+			fields = [field.name for field in arcpy.ListFields(lyr) if field.name in ['HLZ_Stat', 'Value']]
+			sym.colorizer.classificationField = fields[0] if fields else 'Value'
 			sym.colorizer.breakCount = 3
 			sym.colorizer.colorRamp = p.listColorRamps('Slope')[0]
 			sym.colorizer.noDataColor = {'RGB': [0, 0, 0, 0]}
@@ -257,34 +320,99 @@ class HLZSuitability(object):
 			lyr.transparency = 40
 
 		if points:
-			buff_list = []
-			arcpy.SetProgressor('default', 'Buffering...')
-			arcpy.AddMessage('Creating clearance radius for HLZ points...')
-			for plt in plts:
-				buff = arcpy.PairwiseBuffer_analysis(
-					points,
-					PLATFORMS[plt]["fc_name"],
-					PLATFORMS[plt]["clearance"],
-					method='PLANAR')
-				lz = m.addDataFromPath(buff)
-				buff_list.append(lz)
-
-			arcpy.SetProgressor('default', 'Symbolizing buffers...')
-
-			for l in buff_list:
-				sym = l.symbology
-				
-				sym.updateRenderer('UniqueValueRenderer')
-				sym.renderer.fields = ['BUFF_DIST']
-
-				# Apply symbology from gallery
-				for grp in sym.renderer.groups:
-					for itm in grp.items:
-						val = int(itm.values[0][0])
-						if val in [25, 40]:
-							itm.symbol.applySymbolFromGallery('Offset Hatch Border, No Fill')
-							if val == 25:
-								itm.label = '25m Radius'
-							if val == 40:
-								itm.label = '40m Radius'
-				l.symbology = sym
+			self.evaluate_points(points, plts, outputs, clearances, obstacles, grid, db, m)
+
+	def extract_landing_zones(self, plts, outputs, clearances, dem_path, tiles, cache, db, m):
+		"""
+		Second pass over the tiles: label each platform's connected Pass regions,
+		join them across tile edges and write the regions whose inscribed circle
+		fits the platform's clearance as ranked points, {shortname}_LZ, at the
+		circle centers.
+		"""
+		arcpy.SetProgressor('step', 'Extracting landing zones...', 0, len(tiles), 1)
+		components = [ComponentTiles() for _ in plts]
+		for position, block, tile in tiles:
+			slope = tile_slope(dem_path, block, cache)[block.overlap(tile)]
+			for comp, o, c in zip(components, outputs, clearances):
+				# Pad by twice the clearance so circles crossing the tile edge are
+				# measured, and radii well past the clearance still rank correctly
+				margin = clearance_margin(tile, 2 * c)
+				win = read_window(o, *tile.extent, pad=margin)
+				radius = inscribed_radius(win.array == 1, win.grid, tile)
+				comp.add(position, win.array[win.grid.overlap(tile)] == 1, radius, slope, tile)
+			arcpy.SetProgressorPosition()
+
+		sr = arcpy.Describe(dem_path).spatialReference
+		arcpy.SetProgressor('default', 'Writing landing zones...')
+		for plt, comp, c in zip(plts, components, clearances):
+			zones = comp.merge()
+			best = rank(zones, c)
+			arcpy.AddMessage(f'{PLATFORMS[plt]["shortname"]}: {len(best)} of {len(zones["area"])} Pass regions fit a {c:g} m clearance')
+			lz_fc = arcpy.CreateFeatureclass_management(
+				db, f'{PLATFORMS[plt]["shortname"]}_LZ', 'POINT', spatial_reference=sr)
+			fields = [
+				['RANK', 'LONG'],
+				['AREA_M2', 'DOUBLE'],
+				['RADIUS_M', 'DOUBLE'],
+				['MEAN_SLOPE', 'DOUBLE']]
+			arcpy.AddFields_management(lz_fc, fields)
+			with arcpy.da.InsertCursor(lz_fc, ['SHAPE@XY', 'RANK', 'AREA_M2', 'RADIUS_M', 'MEAN_SLOPE']) as cursor:
+				for n, i in enumerate(best, 1):
+					slope = zones['mean_slope'][i]
+					cursor.insertRow(((zones['x'][i], zones['y'][i]), n, zones['area'][i], zones['radius'][i],
+						None if np.isnan(slope) else slope))
+			m.addDataFromPath(lz_fc)
+
+	def evaluate_points(self, points, plts, outputs, clearances, obstacles, grid, db, m):
+		"""
+		Check every candidate point against each platform's clearance disk.  The
+		points are copied to the platform's fc_name with PCT_PASS (percent of
+		the disk that is Pass), WORST_CLASS and OBSTRUCTED (obstructed cells in
+		the disk).  Points are grouped by tile so each tile's rasters are read
+		once, and each group is summarised with one stencil gather.
+		"""
+		arcpy.SetProgressor('default', 'Evaluating HLZ points...')
+		arcpy.AddMessage('Checking HLZ points against platform clearances...')
+		sr = arcpy.Describe(outputs[0]).spatialReference
+		with arcpy.da.SearchCursor(points, ['SHAPE@XY'], spatial_reference=sr) as cursor:
+			xy = np.array([row[0] if row[0] and row[0][0] is not None else (np.nan, np.nan) for row in cursor],
+				dtype=np.float64).reshape(-1, 2)
+		del cursor
+
+		# Points off the processing grid are left Null
+		row, col = grid.rowcol(xy[:, 0], xy[:, 1])
+		inside = (row >= 0) & (row < grid.nrows) & (col >= 0) & (col < grid.ncols)
+		tile_of = np.where(inside, (row // TILE_SIZE) * grid.ncols + col // TILE_SIZE, -1)
+
+		for plt, o, c in zip(plts, outputs, clearances):
+			stencil = disk_stencil(c, grid.cell_w, grid.cell_h)
+			margin = clearance_margin(grid, c)
+			pct_pass = np.full(len(xy), np.nan)
+			worst = np.full(len(xy), CLASS_NODATA, dtype=np.uint8)
+			blocked = np.full(len(xy), -1, dtype=np.int64)
+			for t in np.unique(tile_of[tile_of >= 0]):
+				idx = np.nonzero(tile_of == t)[0]
+				r0 = (row[idx[0]] // TILE_SIZE) * TILE_SIZE
+				c0 = (col[idx[0]] // TILE_SIZE) * TILE_SIZE
+				tile = grid.subgrid(r0, c0, min(TILE_SIZE, grid.nrows - r0), min(TILE_SIZE, grid.ncols - c0))
+				win = read_window(o, *tile.extent, pad=margin)
+				classes = np.where(np.isnan(win.array), CLASS_NODATA, win.array).astype(np.uint8)
+				obstructed = burn_obstructions(win.grid, **obstacles) if obstacles else None
+				r, k = win.grid.rowcol(xy[idx, 0], xy[idx, 1])
+				pct_pass[idx], worst[idx], blocked[idx] = disk_summary(classes, r, k, stencil, obstructed)
+
+			out_fc = arcpy.CopyFeatures_management(points, os.path.join(db, PLATFORMS[plt]["fc_name"]))
+			fields = [
+				['PCT_PASS', 'DOUBLE'],
+				['WORST_CLASS', 'SHORT'],
+				['OBSTRUCTED', 'LONG']]
+			arcpy.AddFields_management(out_fc, fields)
+			with arcpy.da.UpdateCursor(out_fc, [f[0] for f in fields]) as cursor:
+				for i, _ in enumerate(cursor):
+					cursor.updateRow((
+						None if np.isnan(pct_pass[i]) else pct_pass[i],
+						None if worst[i] == CLASS_NODATA else int(worst[i]),
+						None if blocked[i] < 0 or not obstacles else int(blocked[i])))
+			del cursor
+			arcpy.AddMessage(f'{PLATFORMS[plt]["fc_name"]}: {int(np.sum(pct_pass == 100))} of {len(xy)} points are Pass across the whole disk')
+			m.addDataFromPath(out_fc)
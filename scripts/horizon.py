@@ -0,0 +1,296 @@
+"""
+Horizon angles and observer viewsheds, built on the AMROR array engine.
+
+Horizon Angles gives, for every cell of an area, the highest angle at which
+terrain is seen along each of N azimuth sectors, one band per sector.
+Observer Viewsheds gives one binary viewshed raster per observer point,
+named for the output with the observer's OID appended.  Both use
+the AMROR earth curvature model and put the observer a vertical offset above
+the bare earth.
+"""
+import arcpy
+
+arcpy.CheckOutExtension('Spatial')
+from arcpy.sa import *
+import numpy as np
+import os
+import sys
+import time
+
+sys.dont_write_bytecode = True
+
+from scripts.utils.amror_core import CLASS_NODATA, fan_extent
+from scripts.utils.arcarray import TileWriter, feature_polygons, read_window, save_array
+from scripts.utils.grid import Grid
+from scripts.utils.horizon_core import horizon_angles, sector_bearings, sector_rays, viewshed
+from scripts.utils.parallel import ordered_map, timing_summary
+from scripts.utils.rasterize import burn_polygons
+
+
+def horizon_tile(tile, mask, dsm, dtm, sectors, distance, interval, vert_offset, method, rays):
+    """
+    Horizon angles in degrees for one tile of the AO grid as a float32
+    (sectors, rows, cols) array, reading only the terrain the tile needs.
+    """
+    dtm_win = read_window(dtm, *tile.extent, pad=1)
+    bearings = [b for fan in sector_rays(sectors, rays) for b in fan]
+    dsm_win = read_window(dsm, *fan_extent(*tile.extent, bearings, distance), pad=1)
+    angles = horizon_angles(tile, dtm_win, dsm_win, sectors, distance, interval, vert_offset, mask, method, rays)
+    return angles.astype(np.float32)
+
+
+def horizon_job(job):
+    """
+    Process pool entry point: (tile number, tile, mask, args) -> (tile number, angles, seconds).
+    """
+    start = time.perf_counter()
+    number, tile, mask, args = job
+    return number, horizon_tile(tile, mask, *args), time.perf_counter() - start
+
+
+def viewshed_job(job):
+    """
+    Process pool entry point: (band, x, y, args) -> (band, grid, viewshed, seconds).
+    """
+    start = time.perf_counter()
+    band, x, y, (dsm, dtm, radius, observer_offset, target_offset) = job
+    dsm_win = read_window(dsm, x - radius, y - radius, x + radius, y + radius, pad=1)
+    dtm_win = read_window(dtm, x, y, x, y, pad=1)
+    square, vis = viewshed(dsm_win, dtm_win, x, y, radius, observer_offset, target_offset)
+    return band, square, vis, time.perf_counter() - start
+
+
+def default_output(prefix):
+    default_db = arcpy.mp.ArcGISProject('CURRENT').defaultGeodatabase
+    return os.path.join(default_db, arcpy.CreateScratchName(prefix=prefix, suffix='', data_type='RasterDataset'))
+
+
+class HorizonAngles(object):
+
+    def __init__(self):
+        self.category = 'Analysis'
+        self.name = 'HorizonAngles'
+        self.label = 'Horizon Angles'
+        self.alias = 'Calculate Horizon Angles'
+        self.description = 'Calculate the horizon angle in each azimuth sector for every cell in an area'
+        self.canRunInBackground = False
+
+    def getParameterInfo(self):
+
+        pdata = [
+            ['Area of Operations', 'area_of_operations', 'GPString', 'Required', 'Input'],
+            ['AO Layer', 'ao_layer', 'GPFeatureLayer', 'Optional', 'Input'],
+            ['Surface Raster (DSM)', 'surface_raster', ['GPRasterLayer', 'GPRasterDataLayer', 'GPMapServerLayer', 'DEImageServer', 'GPMosaicLayer'], 'Required', 'Input'],
+            ['Bare Earth Raster (DTM)', 'terrain_raster', ['GPRasterLayer', 'GPRasterDataLayer', 'GPMapServerLayer', 'DEImageServer', 'GPMosaicLayer'], 'Required', 'Input'],
+            ['Cell Size (meters)', 'cell_size', 'GPLong', 'Required', 'Input'],
+            ['Azimuth Sectors', 'sectors', 'GPLong', 'Required', 'Input'],
+            ['Distance (meters)', 'distance', 'GPLong', 'Required', 'Input'],
+            ['Interval (meters)', 'interval', 'GPLong', 'Required', 'Input'],
+            ['Vertical Offset (meters)', 'vertical_offset', 'GPLong', 'Required', 'Input'],
+            ['Raster Output', 'raster_output', 'DERasterDataset', 'Optional', 'Output'],
+            ['Tile Size (cells)', 'tile_size', 'GPLong', 'Optional', 'Input'],
+            ['Workers', 'workers', 'GPLong', 'Optional', 'Input'],
+            ['Sampling', 'sampling', 'GPString', 'Optional', 'Input'],
+            ['Rays per Sector', 'rays_per_sector', 'GPLong', 'Optional', 'Input']
+        ]
+
+        params = [
+            arcpy.Parameter(
+                displayName=d[0],
+                name=d[1],
+                datatype=d[2],
+                parameterType=d[3],
+                direction=d[4]) for d in pdata]
+
+        # Presets/Defaults
+        params[0].filter.type = 'ValueList'
+        params[0].filter.list = ['By Polygon', 'By View Extent']
+        params[0].value = 'By View Extent'
+
+        params[1].filter.list = ['Polygon']
+        params[4].value = 25  # Default cell size
+        params[5].value = 8  # Default sectors, one per 45 degrees
+        params[6].value = 5000  # Default distance
+        params[7].value = 20  # Default interval
+        params[8].value = 2  # Default vertical offset
+        params[10].value = 1024  # Default tile edge, bounds peak memory
+        params[11].value = os.cpu_count()  # Default one worker process per core
+        params[12].filter.type = 'ValueList'
+        params[12].filter.list = ['Nearest', 'Bilinear']
+        params[12].value = 'Nearest'
+        params[13].value = 9  # Default rays per sector, 5 degrees apart across 45 degree sectors
+
+        return params
+
+    def isLicensed(self):
+        return True
+
+    def updateParameters(self, parameters):
+        parameters[1].enabled = parameters[0].valueAsText == 'By Polygon'
+        return True
+
+    def updateMessages(self, parameters):
+        if parameters[5].value is not None and parameters[5].value < 1:
+            parameters[5].setErrorMessage('At least one azimuth sector is needed.')
+        if parameters[13].value is not None and parameters[13].value < 1:
+            parameters[13].setErrorMessage('At least one ray per sector is needed.')
+        return True
+
+    def get_view_extent(self):
+        p = arcpy.mp.ArcGISProject('CURRENT')
+        ext = p.activeView.camera.getExtent()
+        ll = ext.lowerLeft
+        ur = ext.upperRight
+        return Extent(ll.X, ll.Y, ur.X, ur.Y)
+
+    def execute(self, parameters, messages):
+        arcpy.env.overwriteOutput = True
+
+        cellsize = parameters[4].value
+        sectors = parameters[5].value
+        distance = parameters[6].value
+        interval = parameters[7].value
+        vert_offset = parameters[8].value
+        tile_size = parameters[10].value or 1024
+        workers = parameters[11].value or 1
+        method = (parameters[12].valueAsText or 'Nearest').lower()
+        rays = parameters[13].value or 1
+
+        # Worker processes cannot see map layers, so hand them dataset paths
+        dsm = arcpy.Describe(parameters[2].valueAsText).catalogPath
+        dtm = arcpy.Describe(parameters[3].valueAsText).catalogPath
+        sr = arcpy.Describe(dsm).spatialReference
+        arcpy.env.outputCoordinateSystem = sr
+
+        ao_polys = None
+        if parameters[0].valueAsText == 'By View Extent':
+            ao_extent = self.get_view_extent()
+            arcpy.AddMessage(f'Using view extent: {ao_extent}')
+        else:
+            poly_lyr = parameters[1].valueAsText
+            ao_polys = feature_polygons(poly_lyr, sr)
+            verts = np.concatenate([ring for rings in ao_polys for ring in rings])
+            ao_extent = Extent(verts[:, 0].min(), verts[:, 1].min(), verts[:, 0].max(), verts[:, 1].max())
+            arcpy.AddMessage(f'Using {len(ao_polys)} polygon(s) from {poly_lyr}, extent: {ao_extent}')
+
+        out_raster = parameters[9].valueAsText or default_output('Horizon_')
+
+        grid = Grid.from_extent(ao_extent.XMin, ao_extent.YMin, ao_extent.XMax, ao_extent.YMax, cellsize)
+        tiles = list(grid.tiles(tile_size))
+        args = (dsm, dtm, sectors, distance, interval, vert_offset, method, rays)
+        jobs = []
+        for number, tile in enumerate(tiles):
+            mask = None
+            if ao_polys:
+                mask = burn_polygons(ao_polys, tile) > 0
+                if not mask.any():
+                    continue
+            jobs.append((number, tile, mask, args))
+        if not jobs:
+            arcpy.AddWarning('The AO polygons do not cover any cells.')
+            return None
+
+        writer = TileWriter(out_raster)
+        timings = {}
+        arcpy.AddMessage(f'Processing {len(jobs)} tiles with {min(workers, len(jobs))} worker(s)')
+        arcpy.SetProgressor('step', 'Calculating horizon angles...', 0, len(jobs), 1)
+        for number, angles, seconds in ordered_map(horizon_job, jobs, min(workers, len(jobs))):
+            writer.write(angles if sectors > 1 else angles[0], tiles[number])
+            timings[number] = seconds
+            arcpy.SetProgressorPosition()
+        arcpy.AddMessage(timing_summary(timings))
+
+        for band, bearing in enumerate(sector_bearings(sectors), 1):
+            arcpy.AddMessage(f'Band_{band}: sector centered on {bearing:g} degrees')
+
+        return writer.out_raster
+
+
+class ObserverViewsheds(object):
+
+    def __init__(self):
+        self.category = 'Analysis'
+        self.name = 'ObserverViewsheds'
+        self.label = 'Observer Viewsheds'
+        self.alias = 'Calculate Observer Viewsheds'
+        self.description = 'Calculate a binary viewshed for each of a batch of observer points'
+        self.canRunInBackground = False
+
+    def getParameterInfo(self):
+
+        pdata = [
+            ['Observer Points', 'observer_points', 'GPFeatureLayer', 'Required', 'Input'],
+            ['Surface Raster (DSM)', 'surface_raster', ['GPRasterLayer', 'GPRasterDataLayer', 'GPMapServerLayer', 'DEImageServer', 'GPMosaicLayer'], 'Required', 'Input'],
+            ['Bare Earth Raster (DTM)', 'terrain_raster', ['GPRasterLayer', 'GPRasterDataLayer', 'GPMapServerLayer', 'DEImageServer', 'GPMosaicLayer'], 'Required', 'Input'],
+            ['Radius (meters)', 'radius', 'GPLong', 'Required', 'Input'],
+            ['Vertical Offset (meters)', 'vertical_offset', 'GPDouble', 'Required', 'Input'],
+            ['Target Offset (meters)', 'target_offset', 'GPDouble', 'Required', 'Input'],
+            ['Raster Output (OID appended per observer)', 'raster_output', 'DERasterDataset', 'Optional', 'Output'],
+            ['Workers', 'workers', 'GPLong', 'Optional', 'Input']
+        ]
+
+        params = [
+            arcpy.Parameter(
+                displayName=d[0],
+                name=d[1],
+                datatype=d[2],
+                parameterType=d[3],
+                direction=d[4]) for d in pdata]
+
+        # Presets/Defaults
+        params[0].filter.list = ['Point']
+        params[3].value = 5000  # Default radius
+        params[4].value = 2  # Default observer height above the DTM
+        params[5].value = 0  # Default target height above the DSM
+        params[7].value = os.cpu_count()  # Default one worker process per core
+
+        return params
+
+    def isLicensed(self):
+        return True
+
+    def updateParameters(self, parameters):
+        return True
+
+    def updateMessages(self, parameters):
+        return True
+
+    def execute(self, parameters, messages):
+        arcpy.env.overwriteOutput = True
+
+        radius = parameters[3].value
+        observer_offset = parameters[4].value
+        target_offset = parameters[5].value
+        workers = parameters[7].value or 1
+
+        dsm = arcpy.Describe(parameters[1].valueAsText).catalogPath
+        dtm = arcpy.Describe(parameters[2].valueAsText).catalogPath
+        sr = arcpy.Describe(dsm).spatialReference
+        arcpy.env.outputCoordinateSystem = sr
+
+        with arcpy.da.SearchCursor(parameters[0].valueAsText, ['OID@', 'SHAPE@XY'], spatial_reference=sr) as cursor:
+            observers = [(oid, xy) for oid, xy in cursor if xy and xy[0] is not None]
+        del cursor
+        if not observers:
+            arcpy.AddWarning('No observer points to process.')
+            return None
+
+        # Each observer's square is written on its own as it arrives, so memory
+        # holds a few squares rather than a band per observer over every square
+        base, ext = os.path.splitext(parameters[6].valueAsText or default_output('Viewshed_'))
+        args = (dsm, dtm, radius, observer_offset, target_offset)
+        jobs = [(band, x, y, args) for band, (_, (x, y)) in enumerate(observers)]
+        outputs = []
+        timings = {}
+        arcpy.AddMessage(f'Processing {len(jobs)} observers with {min(workers, len(jobs))} worker(s)')
+        arcpy.SetProgressor('step', 'Calculating viewsheds...', 0, len(jobs), 1)
+        for band, square, vis, seconds in ordered_map(viewshed_job, jobs, min(workers, len(jobs))):
+            oid = observers[band][0]
+            out_raster = save_array(vis, square, f'{base}_{oid}{ext}', CLASS_NODATA)
+            arcpy.AddMessage(f'{out_raster}: observer OID {oid} (1 visible, 0 hidden)')
+            outputs.append(out_raster)
+            timings[band] = seconds
+            arcpy.SetProgressorPosition()
+        arcpy.AddMessage(timing_summary(timings))
+
+        return ';'.join(outputs)
@@ -1,12 +1,26 @@
 import arcpy
 from datetime import datetime
+from math import ceil, floor
+import numpy as np
 import os
 from pathlib import Path
 import sys
+import time
 
 # Disable writing cache files
 sys.dont_write_bytecode = True
 
+from scipy.spatial import cKDTree
+
+from scripts.utils.align import read_aligned
+from scripts.utils.amror_core import CLASS_NODATA
+from scripts.utils.arcarray import TileWriter, feature_point_oids, feature_points, raster_grid
+from scripts.utils.geodesic import geodesic_rings
+from scripts.utils.grid import Grid
+from scripts.utils.parallel import ordered_map, timing_summary
+from scripts.utils.rings import disk_wkb, circle_template, planar_rings
+from scripts.utils.threat import classify_targets, coverage, masked_bands, regime_ranges
+
 
 ARMS_TABLE = {
     "RUS": [
@@ -196,6 +210,19 @@ ARMS_TABLE = {
 }
 
 
+def masked_band_job(job):
+    """
+    Process pool entry point: (job number, window grid, origins, args) ->
+    (job number, window grid, bands, seconds).  The job's origins share one
+    terrain window, resampled onto the mask grid.
+    """
+    start = time.perf_counter()
+    number, window, origins, (dem, ranges, observer_offset, target_offset) = job
+    terrain = read_aligned(dem, window, 'bilinear')
+    bands = masked_bands(terrain, origins, ranges, observer_offset, target_offset)
+    return number, window, bands, time.perf_counter() - start
+
+
 class SmallArmsRangeRings(object):
     
     def __init__(self):
@@ -228,11 +255,41 @@ class SmallArmsRangeRings(object):
             direction="Input"
         )
         
+        param2 = arcpy.Parameter(
+            displayName="Ring Geometry",
+            name="ring_geometry",
+            datatype="GPString",
+            parameterType="Optional",
+            direction="Input"
+        )
+
         arms_cty_list = ["Russia", "USA"]
         param1.filter.type = "ValueList"
         param1.filter.list = arms_cty_list
+
+        param2.filter.type = "ValueList"
+        param2.filter.list = ["Geodesic", "Planar"]
+        param2.value = "Geodesic"
+
+        pdata = [
+            ["Terrain Mask DEM", "mask_dem", ["DERasterDataset", "GPRasterLayer"], "Optional", None],
+            ["Observer Height (meters)", "observer_offset", "GPDouble", "Optional", 2.0],
+            ["Target Height (meters)", "target_offset", "GPDouble", "Optional", 1.0],
+            ["Mask Cell Size (meters)", "mask_cell_size", "GPDouble", "Optional", 10.0],
+            ["Parallel Workers", "workers", "GPLong", "Optional", os.cpu_count()]
+        ]
+        masking = [
+            arcpy.Parameter(
+                displayName=d[0],
+                name=d[1],
+                datatype=d[2],
+                parameterType=d[3],
+                direction="Input",
+                category="Terrain Masking") for d in pdata]
+        for param, d in zip(masking[1:], pdata[1:]):
+            param.value = d[4]
     
-        return [param0, param1]
+        return [param0, param1, param2] + masking
 
     def isLicensed(self):
         """
@@ -269,6 +326,8 @@ class SmallArmsRangeRings(object):
         #Inputs
         in_fc = parameters[0].valueAsText
         arms_regime = parameters[1].valueAsText
+        geodesic = (parameters[2].valueAsText or "Geodesic") == "Geodesic"
+        mask_dem = parameters[3].valueAsText
 
         try:
             arcpy.SetProgressor("default", "Preparing initial settings...")
@@ -283,46 +342,22 @@ class SmallArmsRangeRings(object):
             arcpy.AddMessage(f"Running multiple ring buffer based on {cty} small arms table.")
         
             in_fc_desc = arcpy.Describe(in_fc)
-            if in_fc_desc.shapeType == "Polygon":
-                side_type = "OUTSIDE_ONLY"
-            else:
-                side_type ="FULL"
+            sr = in_fc_desc.spatialReference
         
             distances = sorted([i['distance'] for i in arms])
-
-            unit = 'meters'
+            labels = {i["distance"]: i["label"] for i in arms}
 
             now = datetime.now().strftime("%Y%m%dT%H%M%S")
             out_fc = os.path.join(default_gdb, f"mrb_{cty}_{now}")
 
-            arcpy.SetProgressor("default", "Running multi-ring buffer analysis...")
-        
-            mrb = arcpy.MultipleRingBuffer_analysis(
-                in_fc,
-                r"in_memory\mr_buffer",
-                distances,
-                unit,
-                "",
-                "NONE",
-                side_type
-            )
-        
-            arcpy.SetProgressor("default", "Updating weapon systems fields...")
-
-            #Add fields and update with weapons/ranges
-            arcpy.AddField_management(mrb, "WeaponSystem", "TEXT")
-            fields = ["distance", "WeaponSystem"]
-        
-            with arcpy.da.UpdateCursor(mrb, fields) as cursor:
-                for row in cursor:
-                    for i in arms:
-                        if row[0] == i["distance"]:
-                            row[1] = i["label"]
-                    cursor.updateRow(row)
-
-            #Write to feature class
-            arcpy.SetProgressor("default", "Writing output...")
-            result = arcpy.CopyFeatures_management(mrb, out_fc)
+            if mask_dem and in_fc_desc.shapeType in ("Point", "Multipoint"):
+                result = self.masked_rings(in_fc, mask_dem, distances, labels, out_fc, parameters)
+            elif in_fc_desc.shapeType in ("Point", "Multipoint") and (geodesic or sr.type == "Projected"):
+                result = self.point_rings(in_fc, sr, distances, labels, out_fc, geodesic)
+            else:
+                result = self.buffer_rings(in_fc, in_fc_desc, distances, labels, out_fc)
+            if result is None:
+                return None
 
             arcpy.SetProgressor("default", "Adding to map...")
 
@@ -344,4 +379,390 @@ class SmallArmsRangeRings(object):
     
         except Exception as e:
             raise e
+
+    def point_rings(self, in_fc, sr, distances, labels, out_fc, geodesic=True):
+        """
+        Rings for point origins from one circle template, all origins and
+        distances in one broadcast, written with a single insert cursor.
+        Geodesic rings are solved on the WGS84 ellipsoid from the origins'
+        latitude and longitude and written in WGS84, whatever the input
+        coordinate system; planar rings use the input's own coordinates.
+        ORIGIN is the OID of the input point each ring was built around.
+        """
+        arcpy.SetProgressor("default", "Building range rings...")
+        if geodesic:
+            sr = arcpy.SpatialReference(4326)
+            origins, oids = feature_point_oids(in_fc, sr)
+            rings = geodesic_rings(origins, distances, circle_template())
+        else:
+            origins, oids = feature_point_oids(in_fc)
+            rings = planar_rings(origins, np.array(distances) / sr.metersPerUnit, circle_template())
+        arcpy.AddMessage(f"Building {rings.shape[0] * rings.shape[1]} rings for {len(origins)} origins.")
+
+        arcpy.SetProgressor("default", "Writing output...")
+        result = arcpy.CreateFeatureclass_management(
+            os.path.dirname(out_fc), os.path.basename(out_fc), "POLYGON", spatial_reference=sr)
+        fields = [
+            ["distance", "DOUBLE"],
+            ["WeaponSystem", "TEXT"],
+            ["ORIGIN", "LONG"]]
+        arcpy.AddFields_management(result, fields)
+        with arcpy.da.InsertCursor(result, ["SHAPE@WKB", "distance", "WeaponSystem", "ORIGIN"]) as cursor:
+            disks = iter(disk_wkb(rings))
+            for oid in oids:
+                for d in distances:
+                    cursor.insertRow((next(disks), d, labels[d], int(oid)))
+        del cursor
+        return result
+
+    def masked_rings(self, in_fc, dem, distances, labels, out_fc, parameters):
+        """
+        Rings cut down to the ground each origin can see.  Every origin gets a
+        radial line-of-sight sweep over the DEM out to the longest range, on a
+        mask grid no finer than the mask cell size.  Origins are grouped so
+        that neighbours share one terrain window, groups are split into chunks
+        so every worker gets a share, chunks run in parallel, and each window's
+        bands are streamed into one raster, keeping the innermost visible band
+        where windows overlap, which is polygonized once for all origins.
+        """
+        dem = arcpy.Describe(dem).catalogPath
+        sr = arcpy.Describe(dem).spatialReference
+        arcpy.env.outputCoordinateSystem = sr
+        observer_offset = parameters[4].value or 0
+        target_offset = parameters[5].value or 0
+        workers = parameters[7].value or 1
+        ranges = np.array(distances, dtype=np.float64) / sr.metersPerUnit
+        reach = ranges[-1]
+
+        # The mask grid sits on the DEM lattice, coarsened to the mask cell size
+        native = raster_grid(dem)
+        step = max(1, int((parameters[6].value or 10) / sr.metersPerUnit // native.cell_w))
+        cell = native.cell_w * step
+        origins = feature_points(in_fc, sr)
+        if not len(origins):
+            arcpy.AddWarning("No origin points to mask.")
+            return None
+        x_min = native.x_min + floor((origins[:, 0].min() - reach - native.x_min) / cell) * cell
+        y_max = native.y_max - floor((native.y_max - origins[:, 1].max() - reach) / cell) * cell
+        grid = Grid(x_min, y_max, cell, cell,
+                    int(ceil((y_max - origins[:, 1].min() + reach) / cell)) + 1,
+                    int(ceil((origins[:, 0].max() + reach - x_min) / cell)) + 1)
+
+        # Origins within the same square of twice the reach share a window, and
+        # a window's origins are split into chunks of at most an even share per
+        # worker so one crowded window does not run on a single worker
+        group = np.floor((origins - origins.min(axis=0)) / (2 * reach)).astype(np.int64)
+        keys, which = np.unique(group, axis=0, return_inverse=True)
+        chunk = max(1, ceil(len(origins) / max(1, workers)))
+        jobs = []
+        window_of = []
+        for number in range(len(keys)):
+            members = origins[which.ravel() == number]
+            row0, col0, row1, col1 = grid.snapped_window(
+                members[:, 0].min() - reach, members[:, 1].min() - reach,
+                members[:, 0].max() + reach, members[:, 1].max() + reach)
+            window = grid.subgrid(row0 - 1, col0 - 1, row1 - row0 + 2, col1 - col0 + 2)
+            for start in range(0, len(members), chunk):
+                jobs.append((len(jobs), window, members[start:start + chunk],
+                             (dem, ranges, observer_offset, target_offset)))
+                window_of.append(number)
+
+        arcpy.AddMessage(f"Masking {len(origins)} origins in {len(keys)} terrain windows ({len(jobs)} jobs) "
+                         f"with {max(1, min(workers, len(jobs)))} worker(s)")
+        arcpy.SetProgressor("step", "Sweeping line of sight...", 0, len(jobs), 1)
+        # A window's chunks come back one after another; each window is written
+        # once its last chunk is in, and overlapping windows keep the lower band
+        writer = TileWriter(arcpy.CreateUniqueName("bands.tif", arcpy.env.scratchFolder), CLASS_NODATA, "MINIMUM")
+        bands = None
+        timings = {}
+        for number, window, chunk_bands, seconds in ordered_map(masked_band_job, jobs, min(workers, len(jobs))):
+            bands = chunk_bands if bands is None else np.minimum(bands, chunk_bands)
+            if number + 1 == len(jobs) or window_of[number + 1] != window_of[number]:
+                writer.write(bands, window)
+                bands = None
+            timings[number] = seconds
+            arcpy.SetProgressorPosition()
+        arcpy.AddMessage(timing_summary(timings))
+
+        arcpy.SetProgressor("default", "Writing output...")
+        band_raster = writer.out_raster
+        result = arcpy.conversion.RasterToPolygon(band_raster, out_fc, "NO_SIMPLIFY", "Value")
+        arcpy.management.Delete(band_raster)
+        arcpy.AddFields_management(result, [["distance", "DOUBLE"], ["WeaponSystem", "TEXT"]])
+        with arcpy.da.UpdateCursor(result, ["gridcode", "distance", "WeaponSystem"]) as cursor:
+            for row in cursor:
+                d = distances[row[0] - 1]
+                cursor.updateRow((row[0], d, labels[d]))
+        del cursor
+        return result
+
+    def buffer_rings(self, in_fc, in_fc_desc, distances, labels, out_fc):
+        """
+        Rings for polygon and line origins, and for planar rings on unprojected
+        data, from MultipleRingBuffer.
+        """
+        if in_fc_desc.shapeType == "Polygon":
+            side_type = "OUTSIDE_ONLY"
+        else:
+            side_type ="FULL"
+
+        unit = 'meters'
+
+        arcpy.SetProgressor("default", "Running multi-ring buffer analysis...")
+    
+        mrb = arcpy.MultipleRingBuffer_analysis(
+            in_fc,
+            r"in_memory\mr_buffer",
+            distances,
+            unit,
+            "",
+            "NONE",
+            side_type
+        )
+    
+        arcpy.SetProgressor("default", "Updating weapon systems fields...")
+
+        #Add fields and update with weapons/ranges
+        arcpy.AddField_management(mrb, "WeaponSystem", "TEXT")
+        fields = ["distance", "WeaponSystem"]
+    
+        with arcpy.da.UpdateCursor(mrb, fields) as cursor:
+            for row in cursor:
+                row[1] = labels.get(row[0])
+                cursor.updateRow(row)
+
+        #Write to feature class
+        arcpy.SetProgressor("default", "Writing output...")
+        return arcpy.CopyFeatures_management(mrb, out_fc)
         
+
+
+class ThreatCoverage(object):
+
+    def __init__(self):
+        """
+        Rasterize how many weapon positions can range each cell, and how many
+        of the regime's weapons reach it, without building ring polygons.
+        """
+        self.category = "Analysis"
+        self.name = "ThreatCoverage"
+        self.label = "Threat Coverage"
+        self.description = "Counts the weapon positions and weapons of an arms regime that can range each cell."
+        self.canRunInBackground = False
+
+    def getParameterInfo(self):
+        """
+        Define Parameters.
+        """
+        param0 = arcpy.Parameter(
+            displayName="Weapon Positions",
+            name="in_fc",
+            datatype="GPFeatureLayer",
+            parameterType="Required",
+            direction="Input"
+        )
+
+        param1 = arcpy.Parameter(
+            displayName="Arms Regime",
+            name="arms_cty",
+            datatype="GPString",
+            parameterType="Required",
+            direction="Input"
+        )
+
+        param2 = arcpy.Parameter(
+            displayName="Cell Size (meters)",
+            name="cell_size",
+            datatype="GPDouble",
+            parameterType="Optional",
+            direction="Input"
+        )
+
+        param3 = arcpy.Parameter(
+            displayName="Output Raster",
+            name="out_raster",
+            datatype="GPString",
+            parameterType="Optional",
+            direction="Input"
+        )
+
+        param1.filter.type = "ValueList"
+        param1.filter.list = ["Russia", "USA"]
+        param2.value = 25
+
+        return [param0, param1, param2, param3]
+
+    def isLicensed(self):
+        return True
+
+    def updateParameters(self, parameters):
+        return True
+
+    def updateMessages(self, parameters):
+        if parameters[0].valueAsText:
+            if arcpy.Describe(parameters[0].valueAsText).spatialReference.type != "Projected":
+                parameters[0].setErrorMessage("Weapon positions must be in a projected coordinate system.")
+        return True
+
+    def execute(self, parameters, messages):
+        """
+        Cells are streamed a tile at a time; each tile is one chunked KD-tree
+        query, so the run time follows the number of cells.
+        """
+        arcpy.env.overwriteOutput = True
+        p = arcpy.mp.ArcGISProject('CURRENT')
+        default_gdb = p.defaultGeodatabase
+
+        in_fc = parameters[0].valueAsText
+        cty = "RUS" if parameters[1].valueAsText == "Russia" else "USA"
+        sr = arcpy.Describe(in_fc).spatialReference
+        arcpy.env.outputCoordinateSystem = sr
+        now = datetime.now().strftime("%Y%m%dT%H%M%S")
+        out_raster = os.path.join(default_gdb, parameters[3].valueAsText or f"threat_{cty}_{now}")
+
+        ranges, labels = regime_ranges(ARMS_TABLE[cty])
+        ranges = ranges / sr.metersPerUnit
+        cell = (parameters[2].value or 25) / sr.metersPerUnit
+        origins = feature_points(in_fc)
+        if not len(origins):
+            arcpy.AddWarning("No weapon positions to map.")
+            return None
+
+        # The AO is everything the longest weapon reaches
+        reach = ranges[-1]
+        grid = Grid.from_extent(origins[:, 0].min() - reach, origins[:, 1].min() - reach,
+                                origins[:, 0].max() + reach, origins[:, 1].max() + reach, cell)
+        tree = cKDTree(origins)
+        tiles = list(grid.tiles(2048))
+        writer = TileWriter(out_raster, -1)
+
+        arcpy.SetProgressor("step", "Mapping threat coverage...", 0, len(tiles), 1)
+        for tile in tiles:
+            count, weapons = coverage(tree, *np.meshgrid(*tile.centers()), ranges)
+            writer.write(np.stack([count, weapons.astype(np.int32)]), tile)
+            arcpy.SetProgressorPosition()
+
+        arcpy.AddMessage(f"Band_1: weapon positions within {ranges[-1] * sr.metersPerUnit:g}m")
+        arcpy.AddMessage("Band_2: weapons reaching from the nearest position")
+        for n, (r, label) in enumerate(zip(ranges[::-1], labels[::-1]), 1):
+            arcpy.AddMessage(f"  {n}: out to {r * sr.metersPerUnit:g}m ({label})")
+        p.activeMap.addDataFromPath(out_raster)
+
+
+class ThreatBands(object):
+
+    def __init__(self):
+        """
+        Tag points with the weapon bands of an arms regime that reach them from
+        the nearest weapon position, with no ring polygons or spatial join.
+        """
+        self.category = "Analysis"
+        self.name = "ThreatBands"
+        self.label = "Tag Points with Threat Bands"
+        self.description = "Tags points with the nearest weapon position and the weapon bands that reach them."
+        self.canRunInBackground = False
+
+    def getParameterInfo(self):
+        """
+        Define Parameters.
+        """
+        param0 = arcpy.Parameter(
+            displayName="Target Points",
+            name="targets",
+            datatype="GPFeatureLayer",
+            parameterType="Required",
+            direction="Input"
+        )
+
+        param1 = arcpy.Parameter(
+            displayName="Weapon Positions",
+            name="in_fc",
+            datatype="GPFeatureLayer",
+            parameterType="Required",
+            direction="Input"
+        )
+
+        param2 = arcpy.Parameter(
+            displayName="Arms Regime",
+            name="arms_cty",
+            datatype="GPString",
+            parameterType="Required",
+            direction="Input"
+        )
+
+        param0.filter.list = ["Point"]
+        param1.filter.list = ["Point"]
+        param2.filter.type = "ValueList"
+        param2.filter.list = ["Russia", "USA"]
+
+        return [param0, param1, param2]
+
+    def isLicensed(self):
+        return True
+
+    def updateParameters(self, parameters):
+        return True
+
+    def updateMessages(self, parameters):
+        if parameters[0].valueAsText:
+            if arcpy.Describe(parameters[0].valueAsText).spatialReference.type != "Projected":
+                parameters[0].setErrorMessage("Target points must be in a projected coordinate system.")
+        return True
+
+    def execute(self, parameters, messages):
+        """
+        Targets are copied to the default geodatabase and tagged from one
+        KD-tree query: NEAREST_M, ORIGIN (the nearest position's OID),
+        THREAT_BAND (1 inside the shortest range, 0 out of range), WEAPONS (how
+        many of the regime's weapons reach) and MIN_WEAPON (the shortest-range
+        weapon that reaches).
+        """
+        arcpy.env.overwriteOutput = True
+        p = arcpy.mp.ArcGISProject('CURRENT')
+        default_gdb = p.defaultGeodatabase
+
+        cty = "RUS" if parameters[2].valueAsText == "Russia" else "USA"
+        sr = arcpy.Describe(parameters[0].valueAsText).spatialReference
+        now = datetime.now().strftime("%Y%m%dT%H%M%S")
+        out_fc = os.path.join(default_gdb, f"threat_bands_{cty}_{now}")
+
+        arcpy.SetProgressor("default", "Reading points...")
+        result = arcpy.CopyFeatures_management(parameters[0].valueAsText, out_fc)
+        # Read in cursor order so the tags line up with the update below
+        with arcpy.da.SearchCursor(result, ["SHAPE@XY"], spatial_reference=sr) as cursor:
+            targets = np.array([row[0] if row[0] and row[0][0] is not None else (np.nan, np.nan) for row in cursor],
+                               dtype=np.float64).reshape(-1, 2)
+        del cursor
+        valid = ~np.isnan(targets[:, 0])
+        origins, origin_oids = feature_point_oids(parameters[1].valueAsText, sr)
+        found = classify_targets(origins * sr.metersPerUnit, targets[valid] * sr.metersPerUnit, ARMS_TABLE[cty])
+        tags = {
+            "distance": np.full(len(targets), np.inf),
+            "origin": np.zeros(len(targets), dtype=np.int64),
+            "band": np.zeros(len(targets), dtype=np.int64),
+            "weapons": np.zeros(len(targets), dtype=np.int64),
+            "label": np.full(len(targets), "", dtype=object)}
+        for key in tags:
+            tags[key][valid] = found[key]
+
+        arcpy.SetProgressor("default", "Tagging points...")
+        fields = [
+            ["NEAREST_M", "DOUBLE"],
+            ["ORIGIN", "LONG"],
+            ["THREAT_BAND", "SHORT"],
+            ["WEAPONS", "SHORT"],
+            ["MIN_WEAPON", "TEXT"]]
+        arcpy.AddFields_management(result, fields)
+        with arcpy.da.UpdateCursor(result, [f[0] for f in fields]) as cursor:
+            for i, _ in enumerate(cursor):
+                reached = np.isfinite(tags["distance"][i])
+                cursor.updateRow((
+                    float(tags["distance"][i]) if reached else None,
+                    int(origin_oids[tags["origin"][i]]) if reached else None,
+                    int(tags["band"][i]),
+                    int(tags["weapons"][i]),
+                    tags["label"][i] or None))
+        del cursor
+
+        arcpy.AddMessage(f"{int(np.sum(tags['band'] > 0))} of {len(targets)} points are within range")
+        p.activeMap.addDataFromPath(result)
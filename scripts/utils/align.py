@@ -0,0 +1,65 @@
+"""
+Grid alignment for rasters that do not share a cell lattice.
+
+Tools pick one raster as the primary and work on its lattice.  common_grid()
+is the part of the primary grid the secondary raster also covers, and
+read_aligned() reads any raster onto a block of that grid, resampling it with
+a scripts.utils.sampler method at the block's cell centers in one vectorized
+call.  Only the secondary cells under the block (plus the sampler's reach)
+are read, so no full-raster Resample is needed before a run.  A raster
+already on the grid's lattice is read directly with no resampling.
+"""
+import numpy as np
+import sys
+
+sys.dont_write_bytecode = True
+
+from scripts.utils.arcarray import raster_grid, read_window
+from scripts.utils.grid import RasterWindow
+from scripts.utils.sampler import sample
+
+REACH = {'nearest': 1, 'bilinear': 2}  # Cells of padding each method draws on
+
+
+def on_lattice(native, grid, tolerance=1e-6):
+    """
+    True when grid's cells coincide with cells of native: same cell size and
+    corners a whole number of cells apart.
+    """
+    if abs(native.cell_w - grid.cell_w) > tolerance * native.cell_w or \
+            abs(native.cell_h - grid.cell_h) > tolerance * native.cell_h:
+        return False
+    cols = (grid.x_min - native.x_min) / native.cell_w
+    rows = (native.y_max - grid.y_max) / native.cell_h
+    return abs(cols - round(cols)) < tolerance and abs(rows - round(rows)) < tolerance
+
+
+def common_grid(primary, secondary):
+    """
+    The cells of the primary raster's grid that the secondary raster's extent
+    also covers.  Raises ValueError when the rasters do not overlap.
+    """
+    native = raster_grid(primary)
+    other = raster_grid(secondary)
+    row0, col0, row1, col1 = native.snapped_window(*other.extent)
+    row0, col0 = max(row0, 0), max(col0, 0)
+    row1, col1 = min(row1, native.nrows), min(col1, native.ncols)
+    if row1 <= row0 or col1 <= col0:
+        raise ValueError(f'{primary} and {secondary} do not overlap')
+    return native.subgrid(row0, col0, row1 - row0, col1 - col0)
+
+
+def read_aligned(raster, grid, method='nearest'):
+    """
+    A float32 RasterWindow of raster on grid, NaN where it is NoData or off the
+    raster.  Rasters on the grid's lattice are read as is; others are resampled
+    with the given method.
+    """
+    if method not in REACH:
+        raise ValueError(f'Unknown sampling method {method!r}')
+    if on_lattice(raster_grid(raster), grid):
+        win = read_window(raster, *grid.extent)
+        return RasterWindow(grid, win.array[win.grid.overlap(grid)])
+    win = read_window(raster, *grid.extent, pad=REACH[method])
+    x, y = np.meshgrid(*grid.centers())
+    return RasterWindow(grid, sample(win, x, y, method).filled(np.nan).astype(np.float32))
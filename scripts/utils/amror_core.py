@@ -0,0 +1,650 @@
+"""
+Array engine for Area Max Rise Over Run.
+
+Instead of building a fishnet, lines of bearing and sample points and joining
+them back together with cursors, every origin cell on the AO grid is treated
+as one element of an array.  Each step along the ray is a fixed x/y offset
+from the origin, so the whole AO is sampled for one step at a time and the
+running maximum inclination is kept per cell.  Terrain is read through
+scripts.utils.sampler, nearest cell or bilinear.
+
+For bearings parallel to a grid axis, cells on the same line of bearing see
+overlapping rays, and line_walk_inclination() walks each line once instead.
+The walk only pays on long runs whose interval divides the cell size (see
+line_walk_pays()); short or off-lattice runs, including the tool defaults of
+1000 m at 20 m, use plain stepping.
+
+When only the mil class matters, threshold_classes() bounds the answer on a
+coarse grid first and only runs the full-resolution engine where the bounds
+straddle a threshold.
+
+Run this module (python -m scripts.utils.amror_core) to cross-check the line
+walk against a brute-force per-sample maximum.
+"""
+from math import atan, ceil, gcd, log2, pi
+import numpy as np
+from scipy import ndimage
+import sys
+
+sys.dont_write_bytecode = True
+
+from scripts.utils.grid import Grid, RasterWindow
+from scripts.utils.sampler import sample
+
+CLASS_NODATA = 255
+NEAR_WIDTHS = 8  # Block widths out before a threshold_classes() block's bounds are used
+
+
+def curvature(sample_distance):
+    """
+    Earth curvature drop (meters) at a distance in meters.  Works on scalars and arrays.
+    """
+    return 0.2032 * ((sample_distance / 1609) ** 2)
+
+
+def ray_offsets(bearing, distance, interval):
+    """
+    Distances along the ray and their x/y offsets for a bearing in degrees
+    clockwise from north.  Samples fall every interval plus the end of the ray,
+    matching GeneratePointsAlongLines with END_POINTS (the origin is skipped).
+    """
+    steps = int(distance // interval)
+    d = interval * np.arange(1, steps + 1, dtype=np.float64)
+    if steps * interval < distance:
+        d = np.append(d, float(distance))
+    rad = np.radians(bearing)
+    return d, d * np.sin(rad), d * np.cos(rad)
+
+
+def ray_extent(x_min, y_min, x_max, y_max, bearing, distance):
+    """
+    Extent of an AO grown by the reach of a ray, i.e. every place a ray sample can land.
+    """
+    rad = np.radians(bearing)
+    dx = distance * np.sin(rad)
+    dy = distance * np.cos(rad)
+    return (min(x_min, x_min + dx),
+            min(y_min, y_min + dy),
+            max(x_max, x_max + dx),
+            max(y_max, y_max + dy))
+
+
+def fan_extent(x_min, y_min, x_max, y_max, bearings, distance):
+    """
+    Union of ray_extent() over several bearings.
+    """
+    extents = np.array([ray_extent(x_min, y_min, x_max, y_max, b, distance) for b in bearings])
+    return extents[:, 0].min(), extents[:, 1].min(), extents[:, 2].max(), extents[:, 3].max()
+
+
+def unique(values):
+    """
+    Drop repeated values, keeping the order they were given in.
+    """
+    return list(dict.fromkeys(values))
+
+
+def combinations(bearings, distances, vertical_offsets):
+    """
+    The (bearing, distance, vertical_offset) tuple behind each output band,
+    ordered by bearing, then distance, then offset.
+    """
+    return [(b, d, v) for b in unique(bearings) for d in unique(distances) for v in unique(vertical_offsets)]
+
+
+def _values(window, x, y, method):
+    """
+    Sampler output as float64 with NaN for NoData, ready for fmax() accumulation.
+    """
+    return sample(window, x, y, method).astype(np.float64).filled(np.nan)
+
+
+def max_inclination(grid, dtm, dsm, bearing, distance, interval, vertical_offset, method='nearest'):
+    """
+    Maximum inclination in degrees from each cell center of grid along a bearing.
+
+    The origin height is the DTM at the cell center plus the vertical offset and
+    each ray sample is the DSM less earth curvature.  Ray samples over NoData are
+    ignored; cells whose origin is NoData, or whose rays see only NoData, are NaN.
+    Both rasters are read with the named scripts.utils.sampler method.
+    """
+    bands, _ = sweep_inclination(grid, dtm, dsm, [bearing], [distance], [vertical_offset], interval,
+                                 method=method)
+    return bands[0]
+
+
+def sweep_inclination(grid, dtm, dsm, bearings, distances, vertical_offsets, interval, mask=None,
+                      method='nearest'):
+    """
+    max_inclination() for every (bearing, distance, vertical offset) combination
+    in one pass over the terrain.
+
+    The origin DTM is sampled once.  For each bearing the DSM is sampled once per
+    step out to the longest distance, with curvature applied once per step; the
+    shorter distances are snapshots of the running maximum as the ray passes
+    them.  Only the final arctangent is repeated per vertical offset.  Long
+    rays on axis-parallel bearings go through line_walk_inclination() instead.
+
+    With a boolean mask only the masked cells are evaluated and the rest are NaN.
+
+    Returns a (bands, rows, cols) array of degrees and the list of
+    (bearing, distance, vertical_offset) tuples describing each band, ordered by
+    bearing, then distance, then offset.
+    """
+    bearings = unique(bearings)
+    distances = unique(distances)
+    vertical_offsets = unique(vertical_offsets)
+    combos = combinations(bearings, distances, vertical_offsets)
+    bands = np.full((len(combos),) + grid.shape, np.nan)
+    if mask is None:
+        mask = np.ones(grid.shape, dtype=bool)
+
+    xs, ys = grid.centers()
+    x, y = np.meshgrid(xs, ys)
+    x, y = x[mask], y[mask]
+    ground = _values(dtm, x, y, method)
+    origins = [ground + vo for vo in vertical_offsets]
+
+    # Distances on the shared interval lattice, and which distances end after each step
+    lattice = interval * np.arange(1, int(max(distances) // interval) + 1, dtype=np.float64)
+    ends = {}
+    for di, dist in enumerate(distances):
+        ends.setdefault(int(dist // interval), []).append(di)
+
+    def incline(surface, d, origin):
+        return np.degrees(np.arctan((surface - origin) / d))
+
+    for bi, bearing in enumerate(bearings):
+        rad = np.radians(bearing)
+        dir_x, dir_y = np.sin(rad), np.cos(rad)
+        best = np.full((len(vertical_offsets),) + x.shape, -np.inf)
+
+        def surface_at(d):
+            return _values(dsm, x + d * dir_x, y + d * dir_y, method) - curvature(d)
+
+        def snapshot(di):
+            dist = distances[di]
+            final = best.copy()
+            if int(dist // interval) * interval < dist:  # The ray end is off the lattice
+                surface = surface_at(dist)
+                for vi, origin in enumerate(origins):
+                    np.fmax(final[vi], incline(surface, dist, origin), out=final[vi])
+            final[np.isneginf(final)] = np.nan
+            first = (bi * len(distances) + di) * len(vertical_offsets)
+            bands[first:first + len(vertical_offsets), mask] = final
+
+        # Long rays on axis-parallel bearings are cheaper to walk line by line
+        walked = [di for di, dist in enumerate(distances) if line_walk_pays(grid, bearing, dist, interval)]
+        for di in walked:
+            first = (bi * len(distances) + di) * len(vertical_offsets)
+            bands[first:first + len(vertical_offsets)] = line_walk_inclination(
+                grid, dtm, dsm, bearing, distances[di], interval, vertical_offsets, mask, method)
+        stepped = [di for di in range(len(distances)) if di not in walked]
+        if not stepped:
+            continue
+
+        for di in ends.get(0, []):
+            if di in stepped:
+                snapshot(di)
+        for k, d in enumerate(lattice[:max(int(distances[di] // interval) for di in stepped)], 1):
+            surface = surface_at(d)
+            for vi, origin in enumerate(origins):
+                np.fmax(best[vi], incline(surface, d, origin), out=best[vi])
+            for di in ends.get(k, []):
+                if di in stepped:
+                    snapshot(di)
+
+    return bands, combos
+
+
+def line_walk_pays(grid, bearing, distance, interval):
+    """
+    Whether line_walk_inclination() applies to a bearing and is expected to beat
+    stepping the whole grid.  It needs a bearing parallel to a grid axis and
+    whole-meter cell size and interval, and pays off once the ray is long
+    compared to the lattice the shared samples have to be taken on.
+
+    Measured on 200x200 cells of 25 m along an axis: with a 25 m interval
+    the walk loses at 1 km (0.51 s against 0.25 s stepping), breaks even near
+    2.5 km and wins at 5 km (0.80 s against 1.18 s) and 10 km (1.16 s against
+    2.27 s).  With a 20 m interval the shared lattice is five times finer and
+    the walk lost at every range tried up to 10 km, so the gate keeps it off.
+    """
+    if bearing % 90 != 0:
+        return False
+    spacing = grid.cell_h if bearing % 180 == 0 else grid.cell_w
+    if not (float(spacing).is_integer() and float(interval).is_integer()):
+        return False
+    steps = int(distance // interval)
+    refine = int(spacing) // gcd(int(spacing), int(interval))
+    return steps >= 2 and steps >= 12 * refine * log2(steps)
+
+
+def _hull_push(stack, size, xs, ws, t, active, leftward):
+    """
+    Push sample t onto the upper hull held in each line's stack.  Points arrive
+    in increasing x, or decreasing x when leftward.  Instead of popping, the
+    insert slot is found by binary search and overwritten, and the overwritten
+    value and old size are returned so the push can be undone.
+    """
+    lines = np.arange(stack.shape[0])
+    sign = -1.0 if leftward else 1.0
+    px, py = xs[t], ws[:, t]
+    lo = np.zeros_like(size)
+    hi = np.maximum(size - 1, 0)
+    while True:
+        unresolved = lo < hi
+        if not unresolved.any():
+            break
+        mid = np.where(unresolved, (lo + hi + 1) // 2, 1)
+        h1 = stack[lines, mid]
+        h0 = stack[lines, mid - 1]
+        ax, ay = xs[h1] - xs[h0], ws[lines, h1] - ws[lines, h0]
+        bx, by = px - xs[h0], py - ws[lines, h0]
+        keep = sign * (ax * by - ay * bx) < 0  # Strictly above the chord to the new point
+        lo = np.where(unresolved & keep, mid, lo)
+        hi = np.where(unresolved & ~keep, mid - 1, hi)
+
+    pos = np.where(size > 0, lo + 1, 0)
+    saved = stack[lines, pos]
+    old_size = size.copy()
+    stack[lines[active], pos[active]] = t
+    size[active] = pos[active] + 1
+    return pos, saved, old_size
+
+
+def _hull_query(stack, size, xs, ws, qx, qy, leftward):
+    """
+    Hull vertex with the greatest slope from a query point left of every hull
+    point, or -1 for an empty hull.  Slope from the query is unimodal along the
+    hull, so the tangent is found by binary search.
+    """
+    lines = np.arange(stack.shape[0])
+
+    def vertex(i):
+        return stack[lines, size - 1 - i] if leftward else stack[lines, i]
+
+    lo = np.zeros_like(size)
+    hi = np.maximum(size - 1, 0)
+    while True:
+        unresolved = lo < hi
+        if not unresolved.any():
+            break
+        mid = (lo + hi) // 2
+        v0 = vertex(np.where(unresolved, mid, 0))
+        v1 = vertex(np.where(unresolved, mid + 1, 0))
+        ax, ay = xs[v0] - qx, ws[lines, v0] - qy
+        bx, by = xs[v1] - qx, ws[lines, v1] - qy
+        tangent = (ax * by - ay * bx) <= 0  # The next vertex is no steeper
+        hi = np.where(unresolved & tangent, mid, hi)
+        lo = np.where(unresolved & ~tangent, mid + 1, lo)
+
+    return np.where(size > 0, vertex(np.minimum(lo, np.maximum(size - 1, 0))), -1)
+
+
+def _window_argmax(z, origin, steps, interval, skip=0):
+    """
+    For each line of evenly spaced samples z (lines, positions) and each origin
+    position t, the index of the sample in (t + skip, t + steps] with the
+    greatest curvature corrected inclination from origin[:, t].
+
+    With x the distance along the line and w = z - k*x^2 (k the curvature
+    coefficient), the curvature corrected slope from an origin at x0 to a sample
+    is the slope between (x0, origin - k*x0^2) and (x, w), plus 2*k*x0.  The
+    best sample is therefore a tangent to the upper convex hull of the window.
+    The line is cut into blocks of one window length; an origin's window is the
+    tail of its own block, grown leftward as the walk moves back, plus the head
+    of the next block, built once and then undone one push at a time.  Every
+    sample is pushed and undone at most once per block and each push and query
+    is a binary search, so the cost per cell is O(log steps) rather than
+    O(steps).
+
+    Returns two index arrays (tail and head candidates), -1 where empty.
+    """
+    nlines, npos = z.shape
+    k = curvature(1.0)
+    xs = interval * np.arange(npos, dtype=np.float64)
+    ws = z - k * xs ** 2
+    qys = origin - k * xs ** 2
+    valid = np.isfinite(ws)
+    has_origin = np.isfinite(origin)
+    length = steps - skip
+
+    tail = np.full(z.shape, -1, dtype=np.int64)
+    head = np.full(z.shape, -1, dtype=np.int64)
+    tail_stack = np.zeros((nlines, length + 1), dtype=np.int64)
+    head_stack = np.zeros((nlines, length + 1), dtype=np.int64)
+    undo = np.zeros((3, nlines, length), dtype=np.int64)
+
+    for block in range(npos // length - 1):
+        start, nxt = block * length, (block + 1) * length
+
+        head_size = np.zeros(nlines, dtype=np.int64)
+        for i in range(length):
+            undo[:, :, i] = _hull_push(head_stack, head_size, xs, ws, nxt + i, valid[:, nxt + i], False)
+
+        # u is the first sample of the window, which belongs to origin t
+        tail_size = np.zeros(nlines, dtype=np.int64)
+        for u in range(nxt, start, -1):
+            t = u - skip - 1
+            if t >= 0 and has_origin[:, t].any():
+                tail[:, t] = _hull_query(tail_stack, tail_size, xs, ws, xs[t], qys[:, t], True)
+                head[:, t] = _hull_query(head_stack, head_size, xs, ws, xs[t], qys[:, t], False)
+
+            # Drop sample u + length - 1 from the head and add sample u - 1 to the tail
+            pos, saved, old_size = undo[:, :, u - 1 - start]
+            head_stack[np.arange(nlines), pos] = saved
+            head_size[:] = old_size
+            _hull_push(tail_stack, tail_size, xs, ws, u - 1, valid[:, u - 1], True)
+
+    tail[~has_origin] = -1
+    head[~has_origin] = -1
+    return tail, head
+
+
+def line_walk_inclination(grid, dtm, dsm, bearing, distance, interval, vertical_offsets, mask=None,
+                          method='nearest'):
+    """
+    max_inclination() for a bearing parallel to a grid axis, for several
+    vertical offsets at once, returned as a (offsets, rows, cols) array.
+
+    Cells in the same grid row (east/west) or column (north/south) lie on a
+    common line of bearing.  Their ray samples all fall on a lattice along that
+    line spaced at gcd(cell size, interval); each residue class of that lattice
+    modulo the interval is an evenly spaced line of samples shared by every
+    origin in the class, which _window_argmax() walks once.  With a mask, only
+    lines holding a masked cell are walked and unmasked cells are NaN.
+    """
+    quarter = int(bearing % 360) // 90  # 0 north, 1 east, 2 south, 3 west
+    to_lines, from_lines = {
+        0: (lambda a: a.T[:, ::-1], lambda a: a[:, ::-1].T),
+        1: (lambda a: a, lambda a: a),
+        2: (lambda a: a.T, lambda a: a.T),
+        3: (lambda a: a[:, ::-1], lambda a: a[:, ::-1]),
+    }[quarter]
+    rad = np.radians(bearing)
+    dir_x, dir_y = np.round(np.sin(rad)), np.round(np.cos(rad))
+
+    if mask is None:
+        mask = np.ones(grid.shape, dtype=bool)
+    walk = to_lines(mask).any(axis=1)
+
+    xs, ys = grid.centers()
+    x, y = np.meshgrid(xs, ys)
+    line_x, line_y = to_lines(x)[walk], to_lines(y)[walk]
+    line_ground = _values(dtm, line_x, line_y, method).ravel()
+    nlines, ncells = line_x.shape
+
+    # Origins on each line sit on the shared lattice at multiples of refine
+    spacing = int(grid.cell_h if quarter in (0, 2) else grid.cell_w)
+    lattice = gcd(spacing, int(interval))
+    refine, stride = spacing // lattice, int(interval) // lattice
+    origin_at = np.arange(ncells) * refine
+    residue, t_origin = origin_at % stride, origin_at // stride
+
+    steps = int(distance // interval)
+    npos = (ceil((t_origin.max() + steps + 1) / steps) + 1) * steps
+    along = lattice * np.arange(stride)[:, None] + interval * np.arange(npos)[None, :]
+    sample_x = line_x[:, :1, None] + along[None] * dir_x
+    sample_y = line_y[:, :1, None] + along[None] * dir_y
+    z = _values(dsm, sample_x, sample_y, method).reshape(nlines * stride, npos)
+
+    rows = (np.arange(nlines)[:, None] * stride + residue[None, :]).ravel()
+    cols = np.broadcast_to(t_origin, (nlines, ncells)).ravel()
+    dist = float(distance)
+    end = None
+    if steps * interval < distance:  # The ray end is off the lattice
+        end = _values(dsm, line_x + dist * dir_x, line_y + dist * dir_y, method) - curvature(dist)
+        end = end.ravel()
+
+    bands = np.full((len(vertical_offsets),) + grid.shape, np.nan)
+    for vi, vo in enumerate(vertical_offsets):
+        origin = np.full(z.shape, np.nan)
+        origin[rows, cols] = line_ground + vo
+        best = np.full(rows.shape, -np.inf)
+        for cand in _window_argmax(z, origin, steps, interval):
+            j = cand[rows, cols]
+            found = j >= 0
+            d = (j[found] - cols[found]) * float(interval)
+            incline = np.degrees(np.arctan(((z[rows[found], j[found]] - curvature(d)) - origin[rows, cols][found]) / d))
+            best[found] = np.fmax(best[found], incline)
+        if end is not None:
+            np.fmax(best, np.degrees(np.arctan((end - (line_ground + vo)) / dist)), out=best)
+        best[np.isneginf(best)] = np.nan
+        walked = np.full(to_lines(mask).shape, np.nan)
+        walked[walk] = best.reshape(nlines, ncells)
+        bands[vi] = np.where(mask, from_lines(walked), np.nan)
+
+    return bands
+
+
+def _filtered(window, size, func, fill):
+    """
+    Window passed through a max/min filter of size (rows, cols) cells, with
+    NoData and everything off the window treated as fill.
+    """
+    array = np.where(np.isnan(window.array), fill, window.array)
+    return RasterWindow(window.grid, func(array, size=size, mode='constant', cval=fill))
+
+
+def threshold_classes(grid, dtm, dsm, bearings, distances, vertical_offsets, interval, thresholds,
+                      factor=4, mask=None, method='nearest'):
+    """
+    Mil class of every cell for a set of mil thresholds, refining only where needed.
+    A cell's class is the number of thresholds at or below its inclination in mils.
+
+    The ray is cut into stretches bounded on a pyramid of blocks whose size
+    grows with distance: blocks of f x f cells bound the stretch from
+    NEAR_WIDTHS to 2 * NEAR_WIDTHS block widths out (the coarsest, factor, to
+    the end of the ray).  Each block samples, at its center, a DSM max filter
+    and DTM min filter wide enough to cover every sample any cell in the block
+    can take (upper bound), and the opposite filters with NoData counted as
+    missing (lower bound).  Every cell is sampled exactly inside the first
+    stretch; a cell whose exact maximum so far and the bounds on the rest of
+    its ray fall in the same class is final, and the rest are sampled exactly
+    one more stretch at a time until they settle, so the result is exact at
+    every threshold.
+
+    The saving is bounded by the exact first stretch, NEAR_WIDTHS of the
+    finest blocks, and by the cells left in doubt, which grow with rough
+    terrain and with thresholds close to the common inclinations.  When the
+    first stretch is over a quarter of the ray there is nothing to save and
+    every cell is swept exactly.  On random terrain at 25 m cells, 8 bearings
+    and three thresholds this ran 1.3-1.5x faster than sweep_inclination() at
+    2.5 km and about 2.3x at 5 km, with 15-20% of cells sampled past the first
+    stretch; at the 1 km default it is the plain sweep.
+
+    Returns uint8 class bands (CLASS_NODATA where NaN), the combos and the
+    fraction of cell results that needed exact samples past the first stretch.
+    """
+    thresholds = np.sort(np.asarray(thresholds, dtype=np.float64))
+    if mask is None:
+        mask = np.ones(grid.shape, dtype=bool)
+    cell = max(grid.cell_w, grid.cell_h)
+
+    # Filter sizes covering a block's spread of origins around its center, plus
+    # a cell either way for nearest-cell rounding and one more for the cells a
+    # bilinear sample draws on
+    reach = 1 if method == 'nearest' else 2
+
+    def blocks(f):
+        coarse = Grid(grid.x_min, grid.y_max, grid.cell_w * f, grid.cell_h * f,
+                      -(-grid.nrows // f), -(-grid.ncols // f))
+
+        def size(window):
+            half_x = (f - 1) / 2 * grid.cell_w
+            half_y = (f - 1) / 2 * grid.cell_h
+            return (2 * (ceil(half_y / window.grid.cell_h) + reach) + 1,
+                    2 * (ceil(half_x / window.grid.cell_w) + reach) + 1)
+
+        cx, cy = np.meshgrid(*coarse.centers())
+        return (f, cx, cy,
+                _filtered(dtm, size(dtm), ndimage.minimum_filter, np.inf).sample(cx, cy).astype(np.float64),
+                _filtered(dtm, size(dtm), ndimage.maximum_filter, np.inf).sample(cx, cy).astype(np.float64),
+                _filtered(dsm, size(dsm), ndimage.maximum_filter, -np.inf),
+                _filtered(dsm, size(dsm), ndimage.minimum_filter, -np.inf))
+
+    def to_fine(a, f):
+        return np.repeat(np.repeat(a, f, axis=-2), f, axis=-1)[..., :grid.nrows, :grid.ncols]
+
+    def incline(z, origin, d):
+        # Infinite filter values stand for NoData, which bounds nothing
+        slope = (z - origin) / d
+        return np.degrees(np.arctan(np.where(np.isfinite(slope), slope, np.nan)))
+
+    def classify(mils):
+        classes = np.searchsorted(thresholds, np.nan_to_num(mils), side='right')
+        return np.where(np.isnan(mils), CLASS_NODATA, classes).astype(np.uint8)
+
+    bearings = unique(bearings)
+    distances = unique(distances)
+    vertical_offsets = unique(vertical_offsets)
+    combos = combinations(bearings, distances, vertical_offsets)
+    classes = np.full((len(combos),) + grid.shape, CLASS_NODATA, dtype=np.uint8)
+    n_vo = len(vertical_offsets)
+
+    # Stretches (first, last] in ray steps: the exact one, then one per block size
+    factors = []
+    f = factor
+    while f >= 2:
+        factors.append(f)
+        f //= 2
+    factors = factors[::-1] or [factor]
+    max_steps = int(max(distances) // interval)
+    edges = [0] + [min(max_steps, max(1, int(NEAR_WIDTHS * f * cell // interval))) for f in factors] + [max_steps]
+
+    xs, ys = grid.centers()
+    x, y = np.meshgrid(xs, ys)
+    ground = _values(dtm, x, y, method)
+    cells = mask & np.isfinite(ground)
+    if 4 * edges[1] > max_steps:
+        # The exact first stretch is most of the ray, so bounds would cost more than they save
+        exact, _ = sweep_inclination(grid, dtm, dsm, bearings, distances, vertical_offsets, interval, cells, method)
+        for i in range(len(combos)):
+            classes[i] = np.where(cells, classify(degrees_to_mils(exact[i])), CLASS_NODATA)
+        return classes, combos, 1.0
+
+    levels = [blocks(f) for f in factors]
+    refined = 0
+
+    for bi, bearing in enumerate(bearings):
+        rad = np.radians(bearing)
+        dir_x, dir_y = np.sin(rad), np.cos(rad)
+
+        def band(dist):
+            return (bi * len(distances) + distances.index(dist)) * n_vo
+
+        def stretch(first, last, sample_at):
+            """
+            Running maximum of sample_at(d) over steps (first, last] of the ray,
+            per distance: each sees the steps up to its own end, and its
+            off-lattice end sample if that falls in the stretch.  None for a
+            distance the stretch does not reach.
+            """
+            run, out = None, {}
+            for step in range(first + 1, min(last, max_steps) + 1):
+                value = sample_at(step * interval)
+                run = value if run is None else np.fmax(run, value)
+                for dist in distances:
+                    if min(int(dist // interval), last) == step:
+                        out[dist] = run
+            for dist in distances:
+                steps = int(dist // interval)
+                if steps * interval < dist and first <= steps and (steps < last or last == max_steps):
+                    end = sample_at(dist)
+                    out[dist] = end if out.get(dist) is None else np.fmax(out[dist], end)
+            return out
+
+        # Bounds on every stretch past the first, once per block
+        bounds = []
+        for (f, cx, cy, origins_lo, origins_hi, dsm_hi, dsm_lo), first, last in zip(levels, edges[1:], edges[2:]):
+            def block_bounds(d):
+                sx, sy = cx + d * dir_x, cy + d * dir_y
+                z_hi = dsm_hi.sample(sx, sy).astype(np.float64) - curvature(d)
+                z_lo = dsm_lo.sample(sx, sy).astype(np.float64) - curvature(d)
+                return np.array([incline(z_hi, origins_lo + vo, d) for vo in vertical_offsets] +
+                                [incline(z_lo, origins_hi + vo, d) for vo in vertical_offsets])
+            # Infinite bounds mean no sample out there is (upper) or is sure to be (lower) valid
+            bounds.append({dist: to_fine(np.where(np.isinf(b), np.nan, b), f)
+                           for dist, b in stretch(first, last, block_bounds).items()})
+
+        # Exact maxima, one stretch at a time for the cells still in doubt
+        active = cells.copy()
+        known = {dist: np.full((n_vo,) + grid.shape, np.nan) for dist in distances}
+        for stage, (first, last) in enumerate(zip(edges, edges[1:])):
+            rows, cols = np.nonzero(active)
+            px, py, origin = x[rows, cols], y[rows, cols], ground[rows, cols]
+
+            def cell_samples(d):
+                z = _values(dsm, px + d * dir_x, py + d * dir_y, method) - curvature(d)
+                return np.array([incline(z, origin + vo, d) for vo in vertical_offsets])
+            for dist, exact in stretch(first, last, cell_samples).items():
+                known[dist][:, rows, cols] = np.fmax(known[dist][:, rows, cols], exact)
+
+            if stage == 1:
+                refined += active.sum() * len(distances) * n_vo
+            doubt = np.zeros(grid.shape, dtype=bool)
+            for dist in distances:
+                upper = known[dist].copy()
+                lower = known[dist].copy()
+                for later in bounds[stage:]:
+                    if dist in later:
+                        np.fmax(upper, later[dist][:n_vo], out=upper)
+                        np.fmax(lower, later[dist][n_vo:], out=lower)
+                for vi in range(n_vo):
+                    up, low = degrees_to_mils(upper[vi]), degrees_to_mils(lower[vi])
+                    settled = np.isfinite(low) & (classify(up) == classify(low))
+                    settled |= np.isnan(up)  # Every sample is NoData, so the exact answer is NaN too
+                    classes[band(dist) + vi] = np.where(active & settled, classify(low), classes[band(dist) + vi])
+                    doubt |= active & ~settled
+            active = doubt
+            if not active.any():
+                break
+
+    return classes, combos, refined / max(mask.sum() * len(combos), 1)
+
+
+def degrees_to_mils(degs):
+    """
+    Convert degrees to mils, with anything outside +/-1600 mils set to NaN.
+    """
+    mils = np.asarray(degs, dtype=np.float64) * (6400 / 360)
+    mils[(mils > 1600) | (mils < -1600)] = np.nan
+    return mils
+
+
+if __name__ == "__main__":
+    # Cross-check the line walk against a brute-force per-sample maximum on
+    # random terrain with NoData holes, for every axis-parallel bearing.
+
+    def calc_degs(dtm, dsm, distance, curvature, vo):
+        return atan(((dsm - curvature) - (dtm + vo)) / distance) * (180 / pi)
+
+    rng = np.random.default_rng(0)
+    terrain = Grid(0, 4000, 10, 10, 400, 400)
+    dsm = RasterWindow(terrain, (rng.random(terrain.shape) * 40).cumsum(axis=1).astype(np.float32) % 300)
+    dsm.array[rng.random(terrain.shape) < 0.01] = np.nan
+    dtm = RasterWindow(terrain, (dsm.array - rng.random(terrain.shape) * 5).astype(np.float32))
+    ao = Grid.from_extent(1200, 1200, 2800, 2800, 25)
+
+    for bearing in (0, 90, 180, 270):
+        for distance, interval in ((1000, 20), (1010, 25), (600, 7)):
+            walk = line_walk_inclination(ao, dtm, dsm, bearing, distance, interval, [0, 2])
+            brute = np.stack([max_inclination(ao, dtm, dsm, bearing, distance, interval, vo) for vo in (0, 2)])
+            assert np.allclose(walk, brute, rtol=0, atol=1e-9, equal_nan=True), (bearing, distance, interval)
+            smooth = line_walk_inclination(ao, dtm, dsm, bearing, distance, interval, [2], method='bilinear')
+            brute = max_inclination(ao, dtm, dsm, bearing, distance, interval, 2, method='bilinear')
+            assert np.allclose(smooth[0], brute, rtol=0, atol=1e-9, equal_nan=True), (bearing, distance, interval)
+
+            # Spot check a few cells one sample at a time
+            xs, ys = ao.centers()
+            d, dx, dy = ray_offsets(bearing, distance, interval)
+            for row, col in rng.integers(0, ao.nrows, (20, 2)):
+                origin = float(dtm.sample(np.array(xs[col]), np.array(ys[row])))
+                samples = [float(dsm.sample(np.array(xs[col] + dx[i]), np.array(ys[row] + dy[i]))) for i in range(len(d))]
+                incl = [calc_degs(origin, s, d[i], curvature(d[i]), 2) if not np.isnan(s) else -9999
+                        for i, s in enumerate(samples)]
+                expected = np.nan if np.isnan(origin) or max(incl) == -9999 else max(incl)
+                assert np.isclose(walk[1, row, col], expected, rtol=0, atol=1e-9, equal_nan=True), (bearing, row, col)
+
+    print('line walk matches brute force')
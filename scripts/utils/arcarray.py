@@ -0,0 +1,145 @@
+"""
+Moves raster blocks between arcpy and NumPy.
+
+read_window() pulls only the cells covering an extent out of a raster (padding
+with NaN where the extent runs off the raster) and save_array() writes an array
+on a Grid back out, so tools never have to hold a whole raster in memory.
+TileWriter streams a raster out one tile at a time.
+"""
+import arcpy
+import numpy as np
+import sys
+
+from scripts.utils.grid import Grid, RasterWindow
+
+sys.dont_write_bytecode = True
+
+
+def raster_grid(raster):
+    """
+    The full native grid of a raster.
+    """
+    r = arcpy.Raster(raster)
+    ext = r.extent
+    return Grid(ext.XMin, ext.YMax, r.meanCellWidth, r.meanCellHeight, r.height, r.width)
+
+
+def read_window(raster, x_min, y_min, x_max, y_max, pad=0):
+    """
+    Read the raster cells covering an extent, plus pad cells all round, into a
+    float32 RasterWindow on the raster's own cell alignment.  NoData and cells
+    off the raster become NaN.
+    """
+    r = arcpy.Raster(raster)
+    native = raster_grid(r)
+    row0, col0, row1, col1 = native.snapped_window(x_min, y_min, x_max, y_max)
+    row0, col0, row1, col1 = row0 - pad, col0 - pad, row1 + pad, col1 + pad
+    grid = native.subgrid(row0, col0, row1 - row0, col1 - col0)
+    array = np.full(grid.shape, np.nan, dtype=np.float32)
+
+    # Only ask arcpy for the part that actually overlaps the raster
+    r0, c0 = max(row0, 0), max(col0, 0)
+    r1, c1 = min(row1, native.nrows), min(col1, native.ncols)
+    if r1 > r0 and c1 > c0:
+        lower_left = arcpy.Point(native.x_min + c0 * native.cell_w, native.y_max - r1 * native.cell_h)
+        block = arcpy.RasterToNumPyArray(r, lower_left, c1 - c0, r1 - r0)
+        if block.ndim == 3:  # Multiband input, terrain lives in the first band
+            block = block[0]
+        valid = np.ones(block.shape, dtype=bool) if r.noDataValue is None else block != r.noDataValue
+        array[r0 - row0:r1 - row0, c0 - col0:c1 - col0] = np.where(valid, block, np.nan)
+
+    return RasterWindow(grid, array)
+
+
+def save_array(array, grid, out_raster, nodata=np.nan):
+    """
+    Write a 2-D (or band-first 3-D) array on a grid to out_raster using the
+    current arcpy.env.outputCoordinateSystem.
+    """
+    ras = arcpy.NumPyArrayToRaster(
+        array,
+        arcpy.Point(grid.x_min, grid.y_min),
+        grid.cell_w,
+        grid.cell_h,
+        value_to_nodata=nodata)
+    ras.save(out_raster)
+    return out_raster
+
+
+class TileWriter(object):
+
+    def __init__(self, out_raster, nodata=np.nan, mosaic_type='LAST'):
+        """
+        Streams tiles into one output raster.  The first tile becomes the output
+        and each later tile is written to a temporary raster in the scratch
+        folder and mosaicked in, so only one tile is ever held in memory.
+        Overlapping tiles are resolved by the Mosaic mosaic_type, the last
+        written by default.
+        """
+        self.out_raster = out_raster
+        self.nodata = nodata
+        self.mosaic_type = mosaic_type
+        self.started = False
+
+    def write(self, array, grid):
+        if not self.started:
+            save_array(array, grid, self.out_raster, self.nodata)
+            self.started = True
+            return
+        tile = arcpy.CreateUniqueName('tile.tif', arcpy.env.scratchFolder)
+        save_array(array, grid, tile, self.nodata)
+        arcpy.management.Mosaic(tile, self.out_raster, self.mosaic_type)
+        arcpy.management.Delete(tile)
+
+
+def feature_parts(features, spatial_reference=None, min_vertices=2):
+    """
+    Vertices of every line or polygon in a layer or feature class (honoring any
+    selection) as one list of (N, 2) part arrays per feature.  Polygon interior
+    rings come out as parts of their own.
+    """
+    shapes = []
+    with arcpy.da.SearchCursor(features, ['SHAPE@'], spatial_reference=spatial_reference) as cursor:
+        for row in cursor:
+            parts = []
+            for part in row[0] or []:
+                ring = []
+                for pnt in list(part) + [None]:  # Interior rings follow a None separator
+                    if pnt is None:
+                        if len(ring) >= min_vertices:
+                            parts.append(np.array(ring))
+                        ring = []
+                    else:
+                        ring.append((pnt.X, pnt.Y))
+            shapes.append(parts)
+    del cursor
+    return shapes
+
+
+def feature_polygons(features, spatial_reference=None):
+    """
+    Rings of every polygon in a layer or feature class (honoring any selection)
+    as lists of (N, 2) arrays, ready for scripts.utils.rasterize.
+    """
+    return feature_parts(features, spatial_reference, min_vertices=3)
+
+
+def feature_points(features, spatial_reference=None):
+    """
+    Every vertex of every feature (one per point for point layers) as an (N, 2) array.
+    """
+    return feature_point_oids(features, spatial_reference)[0]
+
+
+def feature_point_oids(features, spatial_reference=None):
+    """
+    feature_points() along with the OID of the feature each vertex came from,
+    as an (N, 2) array and an (N,) int64 array.  Features with no geometry are
+    skipped, so use the OIDs rather than positions to refer back to the input.
+    """
+    with arcpy.da.SearchCursor(features, ['OID@', 'SHAPE@XY'], spatial_reference=spatial_reference,
+                               explode_to_points=True) as cursor:
+        rows = [(oid, xy) for oid, xy in cursor if xy and xy[0] is not None]
+    del cursor
+    xy = np.array([xy for _, xy in rows], dtype=np.float64).reshape(-1, 2)
+    return xy, np.array([oid for oid, _ in rows], dtype=np.int64)
@@ -0,0 +1,39 @@
+"""
+Array engine for canopy height models.
+
+A canopy height model is the surface (DSM) less the bare earth (DTM), with
+anything lower than MIN_HEIGHT treated as ground clutter rather than canopy.
+The arithmetic is done a block at a time on NaN-masked float32 arrays so a
+CHM of any size runs in the memory of one block.  Bare earth gridded from
+ground returns has holes under dense canopy, which fill_nearest() closes.
+"""
+import numpy as np
+from scipy import ndimage
+import sys
+
+sys.dont_write_bytecode = True
+
+MIN_HEIGHT = 1.8  # Meters; lower returns are shrubs, vehicles and noise
+
+
+def canopy_height(dsm, dtm, min_height=MIN_HEIGHT):
+    """
+    Canopy height of aligned DSM and DTM blocks as float32.  NoData (NaN) in
+    either input and heights below min_height are NaN.
+    """
+    with np.errstate(invalid='ignore'):
+        height = np.asarray(dsm, dtype=np.float32) - np.asarray(dtm, dtype=np.float32)
+        height[~(height >= min_height)] = np.nan
+    return height
+
+
+def fill_nearest(array):
+    """
+    Copy of a float array with each NaN cell set to the value of the nearest
+    cell that has one (all NaN stays all NaN).
+    """
+    missing = np.isnan(array)
+    if not missing.any() or missing.all():
+        return array.copy()
+    idx = ndimage.distance_transform_edt(missing, return_distances=False, return_indices=True)
+    return array[tuple(idx)]
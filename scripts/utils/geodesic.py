@@ -0,0 +1,85 @@
+"""
+Vectorized geodesics on the WGS84 ellipsoid.
+
+direct() solves the geodesic direct problem (start point, azimuth and
+distance to end point) with Vincenty's series, iterated on whole arrays at
+once, so every vertex of every ring for every origin is one call.  Vincenty's
+direct solution converges everywhere and is good to well under a millimeter
+at range-ring distances.
+"""
+import numpy as np
+import sys
+
+sys.dont_write_bytecode = True
+
+A = 6378137.0  # WGS84 semi-major axis, meters
+F = 1 / 298.257223563  # WGS84 flattening
+B = A * (1 - F)
+
+
+def direct(lon, lat, azimuth, distance, tolerance=1e-12, max_iter=50):
+    """
+    End points in degrees of geodesics starting at lon/lat (degrees) on the
+    given azimuths (degrees clockwise from north) and distances (meters).
+    Inputs broadcast against each other.  Longitudes are not wrapped, so a
+    ring over the antimeridian stays one continuous line.
+    """
+    lon, lat, azimuth, distance = np.broadcast_arrays(
+        *(np.asarray(v, dtype=np.float64) for v in (lon, lat, azimuth, distance)))
+    alpha1 = np.radians(azimuth)
+    sin_alpha1, cos_alpha1 = np.sin(alpha1), np.cos(alpha1)
+
+    tan_u1 = (1 - F) * np.tan(np.radians(lat))
+    cos_u1 = 1 / np.sqrt(1 + tan_u1 ** 2)
+    sin_u1 = tan_u1 * cos_u1
+    sigma1 = np.arctan2(tan_u1, cos_alpha1)
+    sin_alpha = cos_u1 * sin_alpha1
+    cos2_alpha = 1 - sin_alpha ** 2
+    u2 = cos2_alpha * (A ** 2 - B ** 2) / B ** 2
+    big_a = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+    big_b = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+
+    sigma = distance / (B * big_a)
+    for _ in range(max_iter):
+        cos_2sm = np.cos(2 * sigma1 + sigma)
+        sin_s, cos_s = np.sin(sigma), np.cos(sigma)
+        delta = big_b * sin_s * (cos_2sm + big_b / 4 * (
+            cos_s * (-1 + 2 * cos_2sm ** 2) -
+            big_b / 6 * cos_2sm * (-3 + 4 * sin_s ** 2) * (-3 + 4 * cos_2sm ** 2)))
+        previous, sigma = sigma, distance / (B * big_a) + delta
+        if np.all(np.abs(sigma - previous) < tolerance):
+            break
+    cos_2sm = np.cos(2 * sigma1 + sigma)
+    sin_s, cos_s = np.sin(sigma), np.cos(sigma)
+
+    tmp = sin_u1 * sin_s - cos_u1 * cos_s * cos_alpha1
+    lat2 = np.arctan2(sin_u1 * cos_s + cos_u1 * sin_s * cos_alpha1, (1 - F) * np.hypot(sin_alpha, tmp))
+    lam = np.arctan2(sin_s * sin_alpha1, cos_u1 * cos_s - sin_u1 * sin_s * cos_alpha1)
+    c = F / 16 * cos2_alpha * (4 + F * (4 - 3 * cos2_alpha))
+    big_l = lam - (1 - c) * F * sin_alpha * (sigma + c * sin_s * (cos_2sm + c * cos_s * (-1 + 2 * cos_2sm ** 2)))
+    return lon + np.degrees(big_l), np.degrees(lat2)
+
+
+def geodesic_rings(origins, distances, template):
+    """
+    Geodesic circles as an (N, D, V, 2) array of lon/lat for (N, 2) lon/lat
+    origins and distances in meters, taking the vertex azimuths from a unit
+    circle template such as rings.circle_template().
+    """
+    origins = np.asarray(origins, dtype=np.float64)
+    azimuth = np.degrees(np.arctan2(template[:, 0], template[:, 1]))
+    lon, lat = direct(origins[:, 0, None, None], origins[:, 1, None, None],
+                      azimuth[None, None, :], np.asarray(distances, dtype=np.float64)[None, :, None])
+    return np.stack([lon, lat], axis=-1)
+
+
+if __name__ == "__main__":
+    # Vincenty's own test line from Flinders Peak to Buninyong
+    def dms(d, m, s):
+        return np.sign(d) * (abs(d) + m / 60 + s / 3600)
+
+    lon2, lat2 = direct(dms(144, 25, 29.52440), dms(-37, 57, 3.72030), dms(306, 52, 5.37), 54972.271)
+    lon_error = (lon2 - dms(143, 55, 35.38390)) * 3600
+    lat_error = (lat2 - dms(-37, 39, 10.15610)) * 3600
+    print(f'lon error {lon_error:.6f}", lat error {lat_error:.6f}"')
+    assert abs(lon_error) < 1e-4 and abs(lat_error) < 1e-4, 'direct() misses the Flinders Peak line by over 1e-4"'
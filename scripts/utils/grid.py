@@ -0,0 +1,137 @@
+"""
+Lightweight raster grid and window classes shared by the array-based tools.
+
+A Grid describes a north-up block of cells (upper-left corner, cell size and
+shape) and a RasterWindow pairs a Grid with a float array of cell values, using
+NaN for NoData.  Neither class touches arcpy so they can be used freely in
+worker processes and from the command line.
+"""
+from math import ceil, floor
+import numpy as np
+
+# Fraction of a cell within which an extent edge is taken to sit on a cell boundary
+SNAP_TOLERANCE = 1e-6
+
+
+class Grid(object):
+
+    def __init__(self, x_min, y_max, cell_w, cell_h, nrows, ncols):
+        self.x_min = x_min
+        self.y_max = y_max
+        self.cell_w = cell_w
+        self.cell_h = cell_h
+        self.nrows = int(nrows)
+        self.ncols = int(ncols)
+
+    @classmethod
+    def from_extent(cls, x_min, y_min, x_max, y_max, cell_w, cell_h=None):
+        """
+        Build a grid anchored on the lower left corner of an extent, the same way
+        CreateFishnet lays out its cells.
+        """
+        cell_h = cell_h or cell_w
+        ncols = max(1, ceil((x_max - x_min) / cell_w))
+        nrows = max(1, ceil((y_max - y_min) / cell_h))
+        return cls(x_min, y_min + nrows * cell_h, cell_w, cell_h, nrows, ncols)
+
+    def __repr__(self):
+        return f'Grid({self.x_min}, {self.y_max}, {self.cell_w}, {self.cell_h}, {self.nrows}, {self.ncols})'
+
+    @property
+    def shape(self):
+        return self.nrows, self.ncols
+
+    @property
+    def x_max(self):
+        return self.x_min + self.ncols * self.cell_w
+
+    @property
+    def y_min(self):
+        return self.y_max - self.nrows * self.cell_h
+
+    @property
+    def extent(self):
+        return self.x_min, self.y_min, self.x_max, self.y_max
+
+    def centers(self):
+        """
+        Cell center coordinates as two 1-D arrays (x by column, y by row, top row first).
+        """
+        xs = self.x_min + (np.arange(self.ncols) + 0.5) * self.cell_w
+        ys = self.y_max - (np.arange(self.nrows) + 0.5) * self.cell_h
+        return xs, ys
+
+    def rowcol(self, x, y):
+        """
+        Integer row/column of the cells containing x/y.  Values may fall outside the grid.
+        """
+        col = np.floor((np.asarray(x) - self.x_min) / self.cell_w).astype(np.int64)
+        row = np.floor((self.y_max - np.asarray(y)) / self.cell_h).astype(np.int64)
+        return row, col
+
+    def snapped_window(self, x_min, y_min, x_max, y_max):
+        """
+        Row/column bounds (row0, col0, row1, col1) of the cells covering an extent.
+        Bounds are not clipped to the grid.  Edges within SNAP_TOLERANCE cells of
+        a cell boundary are taken to be on it, so a grid's own extent (or a
+        tile's) maps back to exactly its cells despite floating point error.
+        """
+        def snap(v):
+            nearest = round(v)
+            return nearest if abs(v - nearest) < SNAP_TOLERANCE else v
+
+        col0 = floor(snap((x_min - self.x_min) / self.cell_w))
+        col1 = ceil(snap((x_max - self.x_min) / self.cell_w))
+        row0 = floor(snap((self.y_max - y_max) / self.cell_h))
+        row1 = ceil(snap((self.y_max - y_min) / self.cell_h))
+        return row0, col0, max(row1, row0 + 1), max(col1, col0 + 1)
+
+    def tiles(self, size):
+        """
+        Split the grid into tiles of at most size x size cells, row by row.
+        """
+        for row0 in range(0, self.nrows, size):
+            for col0 in range(0, self.ncols, size):
+                yield self.subgrid(row0, col0, min(size, self.nrows - row0), min(size, self.ncols - col0))
+
+    def overlap(self, other):
+        """
+        Row and column slices of the cells this grid shares with another grid on
+        the same cell lattice, or None when they do not overlap.
+        """
+        col0 = max(0, round((other.x_min - self.x_min) / self.cell_w))
+        col1 = min(self.ncols, round((other.x_max - self.x_min) / self.cell_w))
+        row0 = max(0, round((self.y_max - other.y_max) / self.cell_h))
+        row1 = min(self.nrows, round((self.y_max - other.y_min) / self.cell_h))
+        if row1 <= row0 or col1 <= col0:
+            return None
+        return slice(row0, row1), slice(col0, col1)
+
+    def subgrid(self, row0, col0, nrows, ncols):
+        return Grid(
+            self.x_min + col0 * self.cell_w,
+            self.y_max - row0 * self.cell_h,
+            self.cell_w,
+            self.cell_h,
+            nrows,
+            ncols)
+
+
+class RasterWindow(object):
+
+    def __init__(self, grid, array):
+        """
+        A block of raster values on a grid.  NoData cells hold NaN.
+        """
+        self.grid = grid
+        self.array = array
+
+    def sample(self, x, y):
+        """
+        Nearest-cell values at x/y.  Points outside the window return NaN.
+        """
+        row, col = self.grid.rowcol(x, y)
+        inside = (row >= 0) & (row < self.grid.nrows) & (col >= 0) & (col < self.grid.ncols)
+        out = np.full(row.shape, np.nan, dtype=self.array.dtype)
+        out[inside] = self.array[row[inside], col[inside]]
+        return out
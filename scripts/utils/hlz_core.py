@@ -0,0 +1,168 @@
+"""
+Array engine for HLZ suitability.
+
+Slope is computed once from a DEM window with Horn's method, then every
+selected platform is classified in the same pass: the reclass ranges of all
+platforms are merged into one sorted list of breakpoints, each cell is binned
+once with np.searchsorted, and a (platforms, bins) lookup table turns the bin
+into every platform's class.  Adding a platform adds one table row and one
+gather, not another trip through the raster.  Land cover and obstruction
+classes come from the same style of lookup and composite() takes the per-cell
+worst case of them all.
+
+Candidate points are checked against their clearance disk with a precomputed
+stencil of cell offsets: disk_summary() gathers the disk of every point in one
+fancy-indexing step, so no buffer geometry is built.
+
+Classes follow the HLZ convention of 1 Pass, 2 Fringe, 3 Fail, with
+CLASS_NODATA (255) for NoData.
+"""
+import numpy as np
+import sys
+
+sys.dont_write_bytecode = True
+
+CLASS_NODATA = 255
+
+
+def horn_slope(dem, cell_w, cell_h):
+    """
+    Slope in degrees of a DEM array by Horn's 3x3 method.  NoData (NaN) cells
+    stay NaN; NoData neighbours, and neighbours off the array, take the center
+    cell's value, the way the Slope tool treats them.
+    """
+    z = np.asarray(dem, dtype=np.float64)
+    padded = np.pad(z, 1, mode='constant', constant_values=np.nan)
+    center = padded[1:-1, 1:-1]
+
+    def at(dr, dc):
+        n = padded[1 + dr:padded.shape[0] - 1 + dr, 1 + dc:padded.shape[1] - 1 + dc]
+        return np.where(np.isnan(n), center, n)
+
+    a, b, c = at(-1, -1), at(-1, 0), at(-1, 1)
+    d, f = at(0, -1), at(0, 1)
+    g, h, i = at(1, -1), at(1, 0), at(1, 1)
+    dz_dx = ((c + 2 * f + i) - (a + 2 * d + g)) / (8 * cell_w)
+    dz_dy = ((g + 2 * h + i) - (a + 2 * b + c)) / (8 * cell_h)
+    return np.degrees(np.arctan(np.hypot(dz_dx, dz_dy)))
+
+
+def compile_reclass(range_tables):
+    """
+    Merge several RemapRange style tables ([[low, high, class], ...], one per
+    platform) into breakpoints and a (tables, bins) uint8 lookup table for
+    classify().
+
+    As with RemapRange, a value on the boundary between two ranges goes to the
+    lower range and the lowest range includes its low end.  Values covered by
+    no range are CLASS_NODATA.  Each breakpoint gets a bin of its own, between
+    the bins of the open intervals either side of it, so boundaries are exact.
+    """
+    breaks = np.unique([v for table in range_tables for low, high, _ in table for v in (low, high)]).astype(np.float64)
+    n = breaks.size
+    lut = np.full((len(range_tables), 2 * n + 1), CLASS_NODATA, dtype=np.uint8)
+    j = np.arange(n)
+    for t, table in enumerate(range_tables):
+        lowest = min(low for low, _, _ in table)
+        # Walk from the last range back so the first range listed wins any overlap
+        for low, high, value in reversed(table):
+            gaps = (j > 0) & (breaks[j - 1] >= low) & (breaks <= high)
+            points = ((breaks > low) & (breaks <= high)) | ((breaks == low) & (low == lowest))
+            lut[t, 2 * j[gaps]] = value
+            lut[t, 2 * j[points] + 1] = value
+    return breaks, lut
+
+
+def classify(values, breaks, lut):
+    """
+    Classes for every table in one pass, as a (tables, rows, cols) uint8 array.
+
+    A value strictly between breaks[j - 1] and breaks[j] lands in bin 2j and a
+    value equal to breaks[j] in bin 2j + 1; NaN sorts past the last breakpoint
+    into the final, NoData, bin.
+    """
+    v = np.asarray(values, dtype=np.float64)
+    bins = np.searchsorted(breaks, v, side='left') + np.searchsorted(breaks, v, side='right')
+    return lut[:, bins]
+
+
+def compile_remap(table):
+    """
+    Sorted keys and classes for a RemapValue style table ([[value, class], ...])
+    for remap().  A "NODATA" class maps its value to CLASS_NODATA and a "NODATA"
+    value (the class for NoData input) is left to remap_nodata().
+    """
+    pairs = sorted((float(value), CLASS_NODATA if cls == 'NODATA' else int(cls))
+                   for value, cls in table if value != 'NODATA')
+    keys = np.array([value for value, _ in pairs], dtype=np.float64)
+    classes = np.array([cls for _, cls in pairs], dtype=np.uint8)
+    return keys, classes
+
+
+def remap_nodata(table):
+    """
+    The class a remap table gives NoData input, CLASS_NODATA unless it has a
+    ["NODATA", class] entry.
+    """
+    return next((int(entry[-1]) for entry in table if entry[0] == 'NODATA'), CLASS_NODATA)
+
+
+def remap(values, keys, classes, nodata_class=CLASS_NODATA):
+    """
+    Classes for exact matches of values against compile_remap() keys.  Values
+    missing from the table are CLASS_NODATA, NaN input is nodata_class.
+    """
+    v = np.asarray(values, dtype=np.float64)
+    idx = np.minimum(np.searchsorted(keys, v), keys.size - 1)
+    out = np.where(keys[idx] == v, classes[idx], CLASS_NODATA).astype(np.uint8)
+    out[np.isnan(v)] = nodata_class
+    return out
+
+
+def composite(*class_arrays):
+    """
+    Per-cell worst case (Pass 1 < Fringe 2 < Fail 3) of aligned class arrays.
+    CLASS_NODATA is the largest uint8 value, so NoData in any input wins, as it
+    does in a Combine.
+    """
+    return np.maximum.reduce([np.asarray(c, dtype=np.uint8) for c in class_arrays])
+
+
+def disk_stencil(radius, cell_w, cell_h):
+    """
+    Row and column offsets of the cells whose centers lie within radius of the
+    center cell's center, for disk_summary().
+    """
+    reach_r, reach_c = int(radius // cell_h), int(radius // cell_w)
+    dr, dc = np.mgrid[-reach_r:reach_r + 1, -reach_c:reach_c + 1]
+    inside = np.hypot(dr * cell_h, dc * cell_w) <= radius
+    return dr[inside], dc[inside]
+
+
+def disk_summary(classes, rows, cols, stencil, obstructed=None, chunk_cells=1 << 22):
+    """
+    Clearance disk statistics for many points at once.  rows and cols locate
+    each point's cell in classes, a uint8 class array with room for the whole
+    stencil around every point, and obstructed is an optional boolean array on
+    the same cells.
+
+    Returns percent of the disk that is Pass (NoData counts against it), the
+    worst class in the disk (CLASS_NODATA if it is all NoData) and the number of
+    obstructed cells.  Points are gathered in chunks of about chunk_cells cells.
+    """
+    dr, dc = stencil
+    n = len(rows)
+    pct_pass = np.zeros(n)
+    worst = np.full(n, CLASS_NODATA, dtype=np.uint8)
+    blocked = np.zeros(n, dtype=np.int64)
+    step = max(1, chunk_cells // dr.size)
+    for start in range(0, n, step):
+        r = rows[start:start + step, None] + dr
+        c = cols[start:start + step, None] + dc
+        disk = classes[r, c]
+        pct_pass[start:start + step] = 100.0 * (disk == 1).sum(axis=1) / dr.size
+        valid = np.where(disk == CLASS_NODATA, 0, disk).max(axis=1)
+        worst[start:start + step] = np.where(valid > 0, valid, CLASS_NODATA)
+        if obstructed is not None:
+            blocked[start:start + step] = obstructed[r, c].sum(axis=1)
+    return pct_pass, worst, blocked
@@ -0,0 +1,121 @@
+"""
+Streaming reader for uncompressed LAS point clouds.
+
+Point records are read straight off disk in chunks with a NumPy structured
+dtype built from the header's record length, so only the fields that are used
+(X, Y, Z, the return byte and classification) are ever unpacked and a file
+larger than memory costs one chunk of RAM.  LAS 1.0 to 1.4 and point data
+formats 0 to 10 are supported; LAZ (compressed) files are not.
+
+surface_grids() bins a whole file onto a grid in one pass: the highest first
+return per cell for the surface and the lowest ground return per cell for the
+bare earth, accumulated with np.maximum.at and np.minimum.at.
+"""
+import numpy as np
+import struct
+import sys
+
+sys.dont_write_bytecode = True
+
+from scripts.utils.grid import Grid
+
+GROUND = 2  # ASPRS ground classification
+
+
+def read_header(path):
+    """
+    The public header block fields needed to read points, as a dict.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(375)
+    if head[:4] != b'LASF':
+        raise ValueError(f'{path} is not a LAS file')
+    major, minor = head[24], head[25]
+    point_format = head[104]
+    if point_format & 0x80 or point_format & 0x40:
+        raise ValueError(f'{path} is compressed (LAZ); decompress it to LAS first')
+    if point_format > 10:
+        raise ValueError(f'Unsupported LAS point data format {point_format}')
+    count = struct.unpack_from('<I', head, 107)[0]
+    if (major, minor) >= (1, 4) and len(head) >= 255:
+        count = struct.unpack_from('<Q', head, 247)[0] or count
+    scale = struct.unpack_from('<3d', head, 131)
+    offset = struct.unpack_from('<3d', head, 155)
+    max_x, min_x, max_y, min_y, max_z, min_z = struct.unpack_from('<6d', head, 179)
+    return {
+        'version': (major, minor),
+        'point_offset': struct.unpack_from('<I', head, 96)[0],
+        'point_format': point_format,
+        'record_length': struct.unpack_from('<H', head, 105)[0],
+        'count': count,
+        'scale': scale,
+        'offset': offset,
+        'extent': (min_x, min_y, max_x, max_y),
+        'z_range': (min_z, max_z),
+    }
+
+
+def point_dtype(header):
+    """
+    Structured dtype over one point record, exposing only the fields used.
+    Formats 6 and up moved the classification byte one place along and widened
+    the return number to four bits.
+    """
+    extended = header['point_format'] >= 6
+    return np.dtype({
+        'names': ['X', 'Y', 'Z', 'returns', 'classification'],
+        'formats': ['<i4', '<i4', '<i4', 'u1', 'u1'],
+        'offsets': [0, 4, 8, 14, 16 if extended else 15],
+        'itemsize': header['record_length'],
+    })
+
+
+def read_points(path, chunk=2000000):
+    """
+    Yield (x, y, z, return_number, classification) arrays for chunks of at most
+    chunk points, in file order, with coordinates scaled to map units.
+    """
+    header = read_header(path)
+    dtype = point_dtype(header)
+    extended = header['point_format'] >= 6
+    (sx, sy, sz), (ox, oy, oz) = header['scale'], header['offset']
+    remaining = header['count']
+    with open(path, 'rb') as f:
+        f.seek(header['point_offset'])
+        while remaining > 0:
+            records = np.fromfile(f, dtype=dtype, count=min(chunk, remaining))
+            if not records.size:
+                break
+            remaining -= records.size
+            return_number = records['returns'] & (0x0F if extended else 0x07)
+            classification = records['classification'] if extended else records['classification'] & 0x1F
+            yield (records['X'] * sx + ox, records['Y'] * sy + oy, records['Z'] * sz + oz,
+                   return_number, classification)
+
+
+def surface_grids(path, cell_size, chunk=2000000):
+    """
+    Grid a point cloud at cell_size in one streaming pass.  Returns the Grid
+    (snapped to whole cells around the header extent) and float32 arrays of
+    the highest first return and the lowest ground return in each cell, NaN
+    where a cell has none.
+    """
+    header = read_header(path)
+    x_min, y_min, x_max, y_max = header['extent']
+    grid = Grid.from_extent(np.floor(x_min / cell_size) * cell_size, np.floor(y_min / cell_size) * cell_size,
+                            np.ceil(x_max / cell_size) * cell_size, np.ceil(y_max / cell_size) * cell_size, cell_size)
+    top = np.full(grid.nrows * grid.ncols, -np.inf)
+    ground = np.full(grid.nrows * grid.ncols, np.inf)
+    for x, y, z, return_number, classification in read_points(path, chunk):
+        row, col = grid.rowcol(x, y)
+        # Points on the max edge of the extent belong to the last row or column
+        row = np.clip(row, 0, grid.nrows - 1)
+        col = np.clip(col, 0, grid.ncols - 1)
+        cell = row * grid.ncols + col
+        first = return_number <= 1  # Some writers leave single returns numbered 0
+        np.maximum.at(top, cell[first], z[first])
+        bare = classification == GROUND
+        np.minimum.at(ground, cell[bare], z[bare])
+    top[np.isinf(top)] = np.nan
+    ground[np.isinf(ground)] = np.nan
+    return grid, top.reshape(grid.shape).astype(np.float32), ground.reshape(grid.shape).astype(np.float32)
@@ -0,0 +1,126 @@
+"""
+Landing zone extraction from HLZ class rasters.
+
+Connected regions of Pass cells are labelled tile by tile with
+scipy.ndimage.label and the labels are joined across tile edges afterwards as
+a graph problem (scipy.sparse.csgraph), so a region spanning many tiles is
+still one landing zone.  Per-region statistics are gathered with bincount and
+lexsort over all labels at once:
+
+- area, from the cell count
+- mean slope, from summed slope over cells with a slope value
+- the largest inscribed clearance circle, from a Euclidean distance transform
+  of the Pass cells; its center is the candidate LZ point
+
+No Python loop runs per region, so AOs with hundreds of thousands of regions
+are fine.
+"""
+import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+import sys
+
+sys.dont_write_bytecode = True
+
+
+class ComponentTiles(object):
+
+    def __init__(self):
+        """
+        Collects per-tile labelling results for merge().  Add tiles in any order
+        with add(), giving each its (tile row, tile column) position.
+        """
+        self.count = 0
+        self.stats = []
+        self.edges = {}
+
+    def add(self, position, passing, radius, slope, grid):
+        """
+        Label the Pass cells of one tile.  passing and slope are arrays on the
+        tile grid; radius is the inscribed circle radius (map units) at each cell,
+        computed with enough context around the tile to be right at its edges.
+        """
+        labels, n = ndimage.label(passing)
+        labels = np.where(labels > 0, labels + self.count, 0)
+        ids = labels[labels > 0]
+        valid = (labels > 0) & ~np.isnan(slope)
+        rows, cols = np.nonzero(labels)
+        xs, ys = grid.centers()
+
+        # Cell of greatest radius per label: sort by label, then radius descending
+        order = np.lexsort((-radius[rows, cols], ids))
+        first = np.unique(ids[order], return_index=True)[1]
+        best = order[first]
+
+        self.stats.append({
+            'cells': np.bincount(ids - self.count - 1, minlength=n),
+            'slope_sum': np.bincount(labels[valid] - self.count - 1, weights=slope[valid], minlength=n),
+            'slope_cells': np.bincount(labels[valid] - self.count - 1, minlength=n),
+            'radius': radius[rows[best], cols[best]],
+            'x': xs[cols[best]],
+            'y': ys[rows[best]],
+            'cell_area': np.full(n, grid.cell_w * grid.cell_h),
+        })
+        self.edges[tuple(position)] = (labels[0], labels[-1], labels[:, 0], labels[:, -1])
+        self.count += n
+
+    def merge(self):
+        """
+        Join labels that touch across tile edges and return per-region arrays:
+        area, radius, mean_slope (NaN without slope), x and y of the circle center.
+        """
+        # Pairs of labels facing each other across a tile edge
+        a, b = [], []
+        for (row, col), (top, bottom, left, right) in self.edges.items():
+            for mine, other, side in ((right, (row, col + 1), 2), (bottom, (row + 1, col), 0)):
+                if other in self.edges:
+                    facing = self.edges[other][side]
+                    touch = (mine > 0) & (facing > 0)
+                    a.append(mine[touch])
+                    b.append(facing[touch])
+        a = np.concatenate(a) - 1 if a else np.zeros(0, dtype=np.int64)
+        b = np.concatenate(b) - 1 if b else np.zeros(0, dtype=np.int64)
+        graph = coo_matrix((np.ones(a.size), (a, b)), shape=(self.count, self.count))
+        n, region = connected_components(graph, directed=False)
+
+        stats = {key: np.concatenate([s[key] for s in self.stats]) for key in self.stats[0]} if self.stats else {}
+        if not n:
+            return {key: np.zeros(0) for key in ('area', 'radius', 'mean_slope', 'x', 'y')}
+        area = np.bincount(region, weights=stats['cells'] * stats['cell_area'], minlength=n)
+        slope_sum = np.bincount(region, weights=stats['slope_sum'], minlength=n)
+        slope_cells = np.bincount(region, weights=stats['slope_cells'], minlength=n)
+        order = np.lexsort((-stats['radius'], region))
+        best = order[np.unique(region[order], return_index=True)[1]]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_slope = np.where(slope_cells > 0, slope_sum / slope_cells, np.nan)
+        return {
+            'area': area,
+            'radius': stats['radius'][best],
+            'mean_slope': mean_slope,
+            'x': stats['x'][best],
+            'y': stats['y'][best],
+        }
+
+
+def inscribed_radius(passing, grid, tile):
+    """
+    Radius of the largest circle of Pass cells centered on each cell: the
+    distance to the nearest non-Pass cell center less half a cell.  passing is
+    on grid, which covers the tile plus a margin all round; the result covers
+    just the tile and is exact up to the narrowest margin.
+    """
+    # A ring of non-Pass cells caps the radius where the context runs out
+    fenced = np.pad(passing, 1, mode='constant', constant_values=False)
+    distance = ndimage.distance_transform_edt(fenced, sampling=(grid.cell_h, grid.cell_w))
+    radius = np.maximum(distance - min(grid.cell_w, grid.cell_h) / 2, 0)
+    return radius[1:-1, 1:-1][grid.overlap(tile)]
+
+
+def rank(zones, clearance):
+    """
+    Indices of the regions whose inscribed circle fits the clearance radius,
+    best first: largest circle, then largest area.
+    """
+    fits = np.nonzero(zones['radius'] >= clearance)[0]
+    return fits[np.lexsort((-zones['area'][fits], -zones['radius'][fits]))]
@@ -0,0 +1,61 @@
+"""
+Process pool helpers for tools that split their work into independent tiles.
+
+ArcGIS Pro runs geoprocessing inside ArcGISPro.exe, which cannot be used to
+spawn worker processes, so the pool is pointed at the python.exe of the active
+environment.  ordered_map() keeps a bounded number of tiles in flight and
+yields results in submission order, so output never depends on which worker
+finishes first.
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import sys
+
+sys.dont_write_bytecode = True
+
+
+def process_pool(workers, initializer=None, initargs=()):
+    if os.path.basename(sys.executable).lower() == 'arcgispro.exe':
+        multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'python.exe'))
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=initializer,
+        initargs=initargs)
+
+
+def ordered_map(fn, items, workers, initializer=None, initargs=()):
+    """
+    Like map(fn, items) but spread over a process pool.  With one worker
+    everything runs in this process.  At most two tiles per worker are pending
+    at any time so results do not pile up in memory.
+    """
+    if workers <= 1:
+        if initializer:
+            initializer(*initargs)
+        for item in items:
+            yield fn(item)
+        return
+
+    with process_pool(workers, initializer, initargs) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(fn, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def timing_summary(timings):
+    """
+    One-line summary of per-tile run times in seconds, keyed by tile number.
+    """
+    if not timings:
+        return 'No tiles processed.'
+    values = list(timings.values())
+    slowest = max(timings, key=timings.get)
+    return (f'{len(values)} tiles: total {sum(values):.1f}s, mean {sum(values) / len(values):.2f}s, '
+            f'min {min(values):.2f}s, max {max(values):.2f}s (tile {slowest})')
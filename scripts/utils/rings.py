@@ -0,0 +1,57 @@
+"""
+Range rings built analytically in bulk.
+
+Every ring of every origin is the same unit circle scaled by the ring
+distance and moved to the origin, so one vertex template is built once and
+all rings come out of a single broadcast: origins (N, 1, 1, 2) plus
+distances (1, D, 1, 1) times the template (1, 1, V, 2).  Each ring is written
+as the full disk it bounds, so an origin's disks overlap, as the rings of
+MultipleRingBuffer with no dissolve do.
+
+disk_wkb() packs the disks as OGC well-known binary polygons with a NumPy
+structured array, so geometry reaches an InsertCursor without building an
+arcpy geometry object per vertex.
+"""
+import numpy as np
+import sys
+
+sys.dont_write_bytecode = True
+
+VERTICES = 360  # Per ring; the chord of a 7.25 km ring then strays under 0.3 m
+
+
+def circle_template(vertices=VERTICES):
+    """
+    Closed unit circle as a (vertices + 1, 2) array of x/y, starting due north
+    and running clockwise, the outer ring orientation of Esri polygons.
+    """
+    angle = np.radians(np.arange(vertices + 1) * 360.0 / vertices)
+    return np.column_stack([np.sin(angle), np.cos(angle)])
+
+
+def planar_rings(origins, distances, template):
+    """
+    Ring vertices for every origin and distance as an (N, D, V, 2) array, with
+    distances in the units of the origin coordinates.
+    """
+    origins = np.asarray(origins, dtype=np.float64).reshape(-1, 1, 1, 2)
+    distances = np.asarray(distances, dtype=np.float64).reshape(1, -1, 1, 1)
+    return origins + distances * template[None, None]
+
+
+def disk_wkb(rings):
+    """
+    WKB polygons for the disks inside (N, D, V, 2) rings, origin by origin and
+    ring by ring from the inside out.  Returns a list of N * D bytes objects.
+    """
+    n, d, v, _ = rings.shape
+    disk = np.dtype([('order', 'u1'), ('type', '<u4'), ('parts', '<u4'),
+                     ('outer_n', '<u4'), ('outer', '<f8', (v, 2))])
+    records = np.zeros(n * d, dtype=disk)
+    records['order'] = 1  # Little endian
+    records['type'] = 3  # Polygon
+    records['parts'] = 1
+    records['outer_n'] = v
+    records['outer'] = rings.reshape(-1, v, 2)
+    buffer, size = records.tobytes(), disk.itemsize
+    return [buffer[i * size:(i + 1) * size] for i in range(len(records))]
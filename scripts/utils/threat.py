@@ -0,0 +1,113 @@
+"""
+Threat coverage from weapon positions without polygons.
+
+A regime is a table of weapon ranges (ARMS_TABLE in small_arms_range_rings).
+Origins go into a KD-tree once; each block of cell centers then needs one
+query_ball_point count (origins close enough to range the cell) and one
+nearest-origin query, and np.searchsorted on the sorted ranges turns the
+nearest distance into the number of weapons that reach.  The work is linear in
+the number of cells and does not grow with how much the rings overlap.
+
+classify_targets() is the same lookup for arbitrary target points, for
+tagging route or friendly positions with the bands that reach them.
+
+masked_bands() is the terrain-aware version of the rings: each origin gets
+an XDraw radial sweep (horizon_core.viewshed) out to the longest range on a
+shared terrain window, and only the cells it can see are given a band.
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+import sys
+
+sys.dont_write_bytecode = True
+
+from scripts.utils.amror_core import CLASS_NODATA
+from scripts.utils.horizon_core import viewshed
+
+
+def regime_ranges(arms):
+    """
+    Sorted weapon ranges of a regime table and the label of each.
+    """
+    arms = sorted(arms, key=lambda i: i["distance"])
+    return np.array([i["distance"] for i in arms], dtype=np.float64), [i["label"] for i in arms]
+
+
+def weapons_in_range(distance, ranges):
+    """
+    Number of weapons in the sorted ranges that reach each distance.
+    """
+    return ranges.size - np.searchsorted(ranges, distance, side='left')
+
+
+def coverage(tree, x, y, ranges, chunk=1 << 20):
+    """
+    Threat coverage at the points x/y (any shape) from the origins in a
+    cKDTree: the number of origins within the regime's longest range and the
+    number of the regime's weapons that reach from the nearest origin.
+    Points are queried in chunks of chunk to bound memory.
+    """
+    xy = np.column_stack([np.ravel(x), np.ravel(y)])
+    count = np.zeros(len(xy), dtype=np.int32)
+    weapons = np.zeros(len(xy), dtype=np.uint8)
+    reach = ranges[-1]
+    for start in range(0, len(xy), chunk):
+        block = xy[start:start + chunk]
+        count[start:start + chunk] = tree.query_ball_point(block, reach, return_length=True)
+        nearest, _ = tree.query(block, distance_upper_bound=reach)
+        weapons[start:start + chunk] = weapons_in_range(nearest, ranges)
+    shape = np.shape(x)
+    return count.reshape(shape), weapons.reshape(shape)
+
+
+def classify_targets(origins, targets, arms, chunk=1 << 20):
+    """
+    Threat bands reaching each of the (M, 2) targets from the (N, 2) origins
+    under a regime table (a list of ARMS_TABLE entries), in the coordinates'
+    units (meters).  Returns a dict of per-target arrays:
+
+    - distance: to the nearest origin (inf with no origins)
+    - origin: index of the nearest origin (N with no origins)
+    - band: 1-based band of the nearest origin the target sits in, 1 being
+      inside the shortest range, 0 out of range of everything
+    - weapons: how many of the regime's weapons reach, the longest-range ones;
+      they are the regime entries from band - 1 onwards in range order
+    - label: label of the shortest-range weapon that reaches ('' for none)
+    """
+    ranges, labels = regime_ranges(arms)
+    targets = np.asarray(targets, dtype=np.float64).reshape(-1, 2)
+    origins = np.asarray(origins, dtype=np.float64).reshape(-1, 2)
+    distance = np.full(len(targets), np.inf)
+    origin = np.full(len(targets), len(origins), dtype=np.int64)
+    if len(origins):
+        tree = cKDTree(origins)
+        for start in range(0, len(targets), chunk):
+            distance[start:start + chunk], origin[start:start + chunk] = tree.query(targets[start:start + chunk])
+    band = np.searchsorted(ranges, distance, side='left') + 1
+    band[band > ranges.size] = 0
+    weapons = np.where(band > 0, ranges.size - band + 1, 0)
+    label = np.array(labels + [''], dtype=object)[np.where(band > 0, band - 1, ranges.size)]
+    return {'distance': distance, 'origin': origin, 'band': band, 'weapons': weapons, 'label': label}
+
+
+def masked_bands(terrain, origins, ranges, observer_offset, target_offset=0):
+    """
+    Line-of-sight masked range bands on the grid of a terrain RasterWindow for
+    (N, 2) origins inside it.  A visible cell gets the 1-based band it falls in
+    from the origin (1 inside the shortest range); where several origins see a
+    cell the innermost band wins.  Cells no origin sees within range are
+    CLASS_NODATA.  The window must reach the longest range around every origin.
+    """
+    bands = np.full(terrain.grid.shape, CLASS_NODATA, dtype=np.uint8)
+    for x, y in origins:
+        square, vis = viewshed(terrain, terrain, x, y, ranges[-1], observer_offset, target_offset)
+        overlap = terrain.grid.overlap(square)
+        if overlap is None:
+            continue
+        xs, ys = square.centers()
+        dist = np.hypot(*np.meshgrid(xs - xs[xs.size // 2], ys - ys[ys.size // 2]))
+        band = (np.searchsorted(ranges, dist, side='left') + 1).astype(np.uint8)
+        band[vis != 1] = CLASS_NODATA
+        rows, cols = square.overlap(terrain.grid)
+        bands[overlap] = np.minimum(bands[overlap], band[rows, cols])
+    return bands
@@ -0,0 +1,98 @@
+"""
+Persistent on-disk cache of computed raster tiles.
+
+Each tile is stored as a .npy file named by a hash of everything that went
+into it (input dataset identities, tool parameters and the tile's place on the
+grid), so a rerun over an overlapping area only computes the tiles it has not
+seen before.  Reading a tile refreshes its modification time and the least
+recently used tiles are deleted once the cache outgrows its size cap.
+"""
+import hashlib
+import json
+import numpy as np
+import os
+import sys
+
+sys.dont_write_bytecode = True
+
+from scripts.utils.userprefs import UserPrefs
+
+
+def dataset_stamp(path):
+    """
+    Identity of an input dataset as (path, modification time).  Datasets inside
+    a file geodatabase, or anything else that is not itself a file, take the
+    newest modification time of the nearest folder that exists on disk, so
+    services and other non-file inputs are identified by path alone.
+    """
+    folder = path
+    while folder and not os.path.exists(folder):
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            return path, None
+        folder = parent
+    if not folder:
+        return path, None
+    if os.path.isfile(folder):
+        return path, os.path.getmtime(folder)
+    stamps = [os.path.getmtime(folder)]
+    stamps += [e.stat().st_mtime for e in os.scandir(folder) if e.is_file()]
+    return path, max(stamps)
+
+
+class TileCache(object):
+
+    def __init__(self, name, max_mb=1024, folder=None):
+        """
+        A cache folder under the user preferences base (~/.igea/<name>) holding
+        at most max_mb megabytes of tiles.
+        """
+        self.folder = folder or os.path.join(UserPrefs().base, name)
+        os.makedirs(self.folder, exist_ok=True)
+        self.max_bytes = max_mb * 1024 * 1024
+
+    @staticmethod
+    def key(**parts):
+        """
+        Stable hash of keyword parts, which must be JSON serializable.
+        """
+        text = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.folder, f'{key}.npy')
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        """
+        The cached array for a key, or None.  A hit marks the tile as recently used.
+        """
+        path = self.path(key)
+        try:
+            array = np.load(path)
+        except (OSError, ValueError):
+            return None
+        os.utime(path)
+        return array
+
+    def put(self, key, array):
+        """
+        Store an array, then evict the least recently used tiles past the size cap.
+        """
+        tmp = self.path(key) + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp, self.path(key))
+        self.evict()
+
+    def evict(self):
+        entries = [e for e in os.scandir(self.folder) if e.name.endswith('.npy')]
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        total = sum(e.stat().st_size for e in entries)
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            total -= entry.stat().st_size
+            os.remove(entry.path)
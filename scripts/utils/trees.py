@@ -0,0 +1,168 @@
+"""
+Individual tree detection on a canopy height model.
+
+Tree tops are local maxima found with a height-adaptive window: taller trees
+have wider crowns, so a cell only counts as a top when it is the highest
+point within a radius that grows with its own height.  Rather than a window
+per cell, cells are grouped by their window's reach in whole cells and each
+reach gets one ndimage.maximum_filter over the whole block.  A cell's window
+depends only on its own height, never on the rest of the block, so tiling
+does not change which cells are tops.  Crowns are the watershed basins
+of the inverted CHM, found by following every cell uphill at once, and crown
+height and area come from bincount over the crown labels.  Canopy cover is the share of canopy cells in coarse cover
+cells, a block mean over a reshaped array.
+"""
+import numpy as np
+from scipy import ndimage
+import sys
+
+sys.dont_write_bytecode = True
+
+from scripts.utils.chm_core import MIN_HEIGHT
+
+MAX_HEIGHT = 60  # Tallest plausible tree in meters; taller cells use its window
+
+
+def crown_radius(height):
+    """
+    Expected crown radius in meters for a tree height in meters, half the
+    crown width from Popescu and Wynne's mixed forest regression.
+    """
+    return (2.51503 + 0.00901 * np.asarray(height, dtype=np.float64) ** 2) / 2
+
+
+def _disk(radius, cell):
+    reach = max(1, int(radius // cell))
+    dr, dc = np.mgrid[-reach:reach + 1, -reach:reach + 1]
+    return np.hypot(dr, dc) * cell <= max(radius, cell)
+
+
+def tree_tops(chm, cell, min_height=MIN_HEIGHT, max_height=MAX_HEIGHT):
+    """
+    Boolean array of tree top cells.  A top is at least min_height tall and
+    the highest cell within crown_radius() of its height (of max_height, for
+    taller cells), rounded up to whole cells; of a flat-topped plateau of
+    equal maxima only one cell is kept.
+    """
+    height = np.where(np.isnan(chm), -np.inf, chm)
+    canopy = height >= min_height
+    tops = np.zeros(chm.shape, dtype=bool)
+    if not canopy.any():
+        return tops
+    reach = np.zeros(chm.shape, dtype=np.int64)
+    reach[canopy] = np.ceil(crown_radius(np.minimum(height[canopy], max_height)) / cell)
+    for r in np.unique(reach[canopy]):
+        footprint = _disk(r * cell, cell)
+        peak = ndimage.maximum_filter(height, footprint=footprint, mode='constant', cval=-np.inf)
+        tops |= canopy & (reach == r) & (height >= peak)
+
+    # One cell per plateau: the first cell of each connected group of tops
+    labels, n = ndimage.label(tops, structure=np.ones((3, 3)))
+    first = np.unique(labels.ravel(), return_index=True)[1][1:]
+    tops[:] = False
+    tops.flat[first] = True
+    return tops
+
+
+def grow_crowns(chm, tops, min_height=MIN_HEIGHT):
+    """
+    Crown label of every cell (0 outside any crown), grown from the tops down
+    the canopy.  Labels follow the order of the tops in the array.
+
+    Each canopy cell points to its highest neighbour when that is higher than
+    itself, and pointer jumping follows every cell uphill to a peak at once, so
+    each drainage basin of the inverted CHM becomes one crown.  Peaks too small
+    to be tree tops hand their basin to the nearest top.
+    """
+    rows, cols = chm.shape
+    height = np.where(np.isnan(chm) | ~(chm >= min_height), -np.inf, chm)
+    canopy = np.isfinite(height)
+    padded = np.pad(height, 1, mode='constant', constant_values=-np.inf)
+    index = np.arange(rows * cols).reshape(rows, cols)
+    parent, best = index.copy(), height.copy()
+    for dr in (-1, 0, 1):
+        for dc in (-1, 0, 1):
+            if dr or dc:
+                neighbour = padded[1 + dr:1 + dr + rows, 1 + dc:1 + dc + cols]
+                higher = neighbour > best
+                best = np.where(higher, neighbour, best)
+                parent = np.where(higher, index + dr * cols + dc, parent)
+    parent = parent.ravel()
+    while True:
+        jumped = parent[parent]
+        if np.array_equal(jumped, parent):
+            break
+        parent = jumped
+
+    labels = np.zeros(rows * cols, dtype=np.int32)
+    labels[tops.ravel()] = np.arange(1, tops.sum() + 1)
+    if tops.any():
+        # Peaks that are not tops take the label of the nearest top
+        nearest = ndimage.distance_transform_edt(~tops, return_distances=False, return_indices=True)
+        peaks = (parent == np.arange(rows * cols)) & canopy.ravel() & ~tops.ravel()
+        labels[peaks] = labels[np.ravel_multi_index(tuple(i.ravel()[peaks] for i in nearest), (rows, cols))]
+    crowns = labels[parent].reshape(rows, cols)
+    crowns[~canopy] = 0
+    return crowns
+
+
+def crown_stats(chm, crowns, cell_area):
+    """
+    Height (the crown's highest cell) and area of crowns 1..n as arrays.
+    """
+    n = crowns.max()
+    inside = crowns > 0
+    area = np.bincount(crowns[inside], minlength=n + 1)[1:] * cell_area
+    height = np.full(n + 1, -np.inf)
+    np.maximum.at(height, crowns[inside], chm[inside])
+    return height[1:], area
+
+
+def canopy_cover(chm, factor, min_height=MIN_HEIGHT):
+    """
+    Percent of the cells in each factor x factor block of the CHM that are
+    canopy, at least min_height tall.  NaN counts as open ground, since CHMs
+    leave everything under min_height NoData; partial blocks at the edges
+    count only the cells they have.
+    """
+    rows, cols = -(-chm.shape[0] // factor), -(-chm.shape[1] // factor)
+    canopy = np.zeros((rows * factor, cols * factor))
+    cells = np.zeros(canopy.shape)
+    with np.errstate(invalid='ignore'):
+        canopy[:chm.shape[0], :chm.shape[1]] = chm >= min_height
+    cells[:chm.shape[0], :chm.shape[1]] = 1
+    canopy = canopy.reshape(rows, factor, cols, factor).sum(axis=(1, 3))
+    cells = cells.reshape(rows, factor, cols, factor).sum(axis=(1, 3))
+    return (100.0 * canopy / cells).astype(np.float32)
+
+
+if __name__ == "__main__":
+    # Tops found tile by tile, each tile read with the Tree Tops and Canopy
+    # Cover tool's padding, must match a run over the whole CHM.
+
+    from scripts.utils.grid import Grid
+
+    rng = np.random.default_rng(0)
+    cell = 1.0
+    rows, cols = 600, 700
+    yy, xx = np.mgrid[:rows, :cols]
+    chm = np.zeros((rows, cols))
+    for r, c, h in zip(rng.integers(0, rows, 900), rng.integers(0, cols, 900), rng.uniform(3, 45, 900)):
+        width = crown_radius(h) / 2
+        np.maximum(chm, h * np.exp(-((yy - r) ** 2 + (xx - c) ** 2) / (2 * width ** 2)), out=chm)
+    chm += rng.uniform(0, 0.05, chm.shape)
+    chm[chm < MIN_HEIGHT] = np.nan
+
+    whole = tree_tops(chm, cell)
+    grid = Grid(0, rows * cell, cell, cell, rows, cols)
+    pad = int(np.ceil(2 * crown_radius(MAX_HEIGHT) / cell))
+    for size in (128, 200, 333):
+        tiled = np.zeros_like(whole)
+        for tile in grid.tiles(size):
+            row0, col0, row1, col1 = grid.snapped_window(*tile.extent)
+            r0, c0 = max(row0 - pad, 0), max(col0 - pad, 0)
+            window = chm[r0:min(row1 + pad, rows), c0:min(col1 + pad, cols)]
+            tops = tree_tops(window, cell)
+            tiled[row0:row1, col0:col1] = tops[row0 - r0:row1 - r0, col0 - c0:col1 - c0]
+        assert np.array_equal(tiled, whole), size
+    print(f'{whole.sum()} tops, the same for every tile size')